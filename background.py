@@ -0,0 +1,198 @@
+"""
+Running a Simulation in a separate process, so
+it can use a whole core without holding up the
+process drawing it.
+
+The worker shows its progress through a window
+of the world, a fixed number of cells across,
+which follows the ant. The window is double
+buffered in shared memory: the worker fills in
+whichever buffer the reader isn't using, then
+publishes it, and the reader gets a view of the
+latest published buffer without copying it.
+For example:
+    sim = BackgroundSimulation('RL', size=(128, 128))
+    ...
+    frame = sim.latest()
+    if frame is not None:
+        gridview.grid = frame.cells
+    ...
+    sim.close()
+"""
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Deliberately doesn't import pygame or ui.
+import simulation
+
+
+# Indices into the control block
+LATEST = 0   # The buffer last published, or -1
+READING = 1  # The buffer the reader has, or -1
+CONTROL_SIZE = 2
+
+# Indices into each buffer's info
+NUMBER, STEPS, X, Y, DIRECTION, LEFT, TOP = range(7)
+INFO_SIZE = 8
+
+
+# A published buffer. cells is a read-only view
+# of it, indexed [y, x], with its top left at
+# origin in the world. ant is (x, y, direction).
+Frame = collections.namedtuple('Frame', 'number cells origin ant steps')
+
+
+def _arrays(buf, size):
+    """
+    Returns (control, info, cells) views of
+    the shared memory for a window of size.
+    """
+    width, height = size
+    control = np.ndarray((CONTROL_SIZE,), np.int64, buf)
+    offset = control.nbytes
+    info = np.ndarray((2, INFO_SIZE), np.int64, buf, offset)
+    offset += info.nbytes
+    cells = np.ndarray((2, height, width), np.uint8, buf, offset)
+    return control, info, cells
+
+
+def _nbytes(size):
+    width, height = size
+    return 8 * (CONTROL_SIZE + 2 * INFO_SIZE) + 2 * width * height
+
+
+def _work(shm, size, lock, stop, rule, pos, chunk, detect_highways):
+    """
+    The worker process: step the simulation and
+    publish the window after each chunk of steps,
+    until stop is set.
+    """
+    control, info, cells = _arrays(shm.buf, size)
+    width, height = size
+    sim = simulation.Simulation(rule, pos=pos,
+                                detect_highways=detect_highways)
+    left = top = None
+    number = 0
+
+    try:
+        while not stop.is_set():
+            with lock:
+                latest = int(control[LATEST])
+                reading = int(control[READING])
+            b = 1 - latest if latest >= 0 else 0
+            if b != reading:
+                # Keep the window around the ant,
+                # moving it only when the ant gets
+                # near the edge (or jumps off it).
+                margin_x, margin_y = width // 8, height // 8
+                if left is None or not (
+                        left + margin_x <= sim.x < left + width - margin_x and
+                        top + margin_y <= sim.y < top + height - margin_y):
+                    left, top = sim.x - width // 2, sim.y - height // 2
+                cells[b] = sim.region(left, top, left + width, top + height)
+                number += 1
+                info[b, :7] = (number, sim.steps, sim.x, sim.y,
+                               sim.direction, left, top)
+                with lock:
+                    control[LATEST] = b
+            # Otherwise the reader still has the
+            # buffer we'd write, so carry on and
+            # publish after the next chunk.
+
+            sim.step(chunk)
+    finally:
+        # Let go of the views, so the
+        # shared memory can be closed.
+        del control, info, cells
+        shm.close()
+
+
+class BackgroundSimulation:
+    """
+    A Simulation stepped as fast as possible
+    in a separate process.
+    """
+    def __init__(self, rule, size=(256, 256), **kwargs):
+        """
+        Starts the simulation of the given rule.
+        size is the (width, height) of the window
+        of cells published.
+        Allows the following keyword arguments:
+          pos: The starting (x, y) of the ant.
+               By default it starts in the
+               center of the simulation's grid.
+          chunk: The number of steps between
+                 publishing the window. Highways
+                 are only skipped in chunks of at
+                 least 4*simulation.MAX_PERIOD steps.
+                 Default 20000.
+          detect_highways: Whether to skip ahead
+                           along highways.
+                           Default True.
+        """
+        # Check the rule here rather
+        # than failing in the worker.
+        simulation.parse_rule(rule)
+
+        self.size = tuple(size)
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=_nbytes(self.size))
+        self._control, self._info, self._cells = _arrays(self._shm.buf,
+                                                         self.size)
+        self._control[:] = -1
+
+        self._lock = multiprocessing.Lock()
+        self._stop = multiprocessing.Event()
+        self._worker = multiprocessing.Process(
+            target=_work,
+            args=(self._shm, self.size, self._lock, self._stop, rule,
+                  kwargs.get('pos'), kwargs.get('chunk', 20000),
+                  kwargs.get('detect_highways', True)),
+            daemon=True)
+        self._worker.start()
+
+    @property
+    def alive(self):
+        """
+        Whether the worker is still running.
+        """
+        return self._worker.is_alive()
+
+    def latest(self):
+        """
+        Returns the latest published Frame, or
+        None if there isn't one yet. Its cells
+        stay as they are until the next call,
+        after which they may be overwritten.
+        """
+        with self._lock:
+            b = int(self._control[LATEST])
+            self._control[READING] = b
+        if b < 0:
+            return None
+
+        number, steps, x, y, direction, left, top = \
+            self._info[b, :7].tolist()
+        cells = self._cells[b]
+        cells.flags.writeable = False
+        return Frame(number, cells, (left, top), (x, y, direction), steps)
+
+    def close(self):
+        """
+        Stop the worker and free the shared
+        memory. Frames from latest() mustn't
+        be used afterwards.
+        """
+        self._stop.set()
+        self._worker.join()
+        self._shm.unlink()
+        del self._control, self._info, self._cells
+        try:
+            self._shm.close()
+        except BufferError:
+            # Someone still has a frame. The memory
+            # goes when it's garbage collected.
+            pass
@@ -0,0 +1,252 @@
+"""
+A headless benchmark for the ui module.
+
+Builds scenes of Checkboxes, Buttons and nested
+Containers, drives them with synthetic clicks and
+reports how long update, draw and handle_event take
+per frame.
+
+Runs without a display, e.g.:
+    python benchmark.py --scene checkboxes -n 1000
+    python benchmark.py --json results.json
+"""
+import os, sys, json, time, random, argparse
+
+# This must be set before pygame is initialised.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+# Keep stdout clean for --json -
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+
+
+WINDOW_SIZE = (1000, 1000)
+CELL = 50
+
+PHASES = ('handle_event', 'update', 'draw')
+PERCENTILES = (50, 90, 99)
+
+
+def _grid_positions(n, size=CELL):
+    """
+    Yields n positions on a grid
+    that fills the window row by row.
+    """
+    per_row = max(1, WINDOW_SIZE[0] // size)
+    for i in range(n):
+        yield ((i % per_row) * size, (i // per_row) * size)
+
+
+def build_checkboxes(ui, n):
+    root = ui.UnboundedContainer()
+    for pos in _grid_positions(n):
+        root.children.append(ui.Checkbox(pos))
+    return root
+
+def build_buttons(ui, n):
+    root = ui.UnboundedContainer()
+    font = ui.get_font(None, 24)
+    for i, pos in enumerate(_grid_positions(n)):
+        root.children.append(ui.Button(pos, size=(CELL, CELL),
+                                       text=str(i), font=font))
+    return root
+
+def build_nested(ui, n, depth=3):
+    """
+    A chain of depth Containers, with
+    the n checkboxes in the innermost one.
+    """
+    root = ui.UnboundedContainer()
+    parent = root
+    for d in range(depth):
+        c = ui.Container((5, 5), size=WINDOW_SIZE)
+        parent.children.append(c)
+        parent = c
+    for pos in _grid_positions(n):
+        parent.children.append(ui.Checkbox(pos))
+    return root
+
+def build_mixed(ui, n):
+    root = ui.UnboundedContainer()
+    font = ui.get_font(None, 24)
+    for i, pos in enumerate(_grid_positions(n)):
+        if i % 2:
+            root.children.append(ui.Checkbox(pos))
+        else:
+            root.children.append(ui.Button(pos, size=(CELL, CELL),
+                                           text=str(i), font=font))
+    return root
+
+def build_scroll(ui, n):
+    """
+    The n buttons in one column of a
+    ScrollContainer, scrolled part way.
+    Only the ones in view cost anything.
+    """
+    font = ui.get_font(None, 24)
+    scroll = ui.ScrollContainer((0, 0), size=WINDOW_SIZE, children=[
+        ui.Button((0, 0), size=(WINDOW_SIZE[0] - 10, CELL), text=str(i),
+                  font=font)
+        for i in range(n)])
+    scroll.scroll = scroll.content_height // 2
+    return ui.UnboundedContainer(children=[scroll])
+
+SCENES = {
+    'checkboxes': build_checkboxes,
+    'buttons': build_buttons,
+    'nested': build_nested,
+    'mixed': build_mixed,
+    'scroll': build_scroll,
+}
+
+
+def percentile(sorted_values, p):
+    """
+    The p-th percentile of a sorted
+    list, by the nearest-rank method.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarise(samples):
+    """
+    Summarises a list of timings (in seconds)
+    as a dict of statistics in milliseconds.
+    """
+    values = sorted(samples)
+    stats = {
+        'mean': 1000 * sum(values) / len(values) if values else 0.0,
+        'max': 1000 * values[-1] if values else 0.0,
+    }
+    for p in PERCENTILES:
+        stats['p%d' % p] = 1000 * percentile(values, p)
+    return stats
+
+
+def run_scene(ui, screen, name, n, frames, clicks_per_frame, full_draw, seed):
+    """
+    Build and run a single scene.
+    Returns a dict of results.
+    """
+    random.seed(seed)
+
+    start = time.perf_counter()
+    root = SCENES[name](ui, n)
+    build_time = time.perf_counter() - start
+
+    bg_colour = (255, 255, 255)
+    screen.fill(bg_colour)
+
+    timings = {phase: [] for phase in PHASES}
+    timings['frame'] = []
+
+    for f in range(frames):
+        events = []
+        for i in range(clicks_per_frame):
+            pos = (random.randrange(WINDOW_SIZE[0]),
+                   random.randrange(WINDOW_SIZE[1]))
+            events.append((pygame.event.Event(pygame.MOUSEBUTTONUP,
+                                              pos=pos, button=1), pos))
+
+        t0 = time.perf_counter()
+        for event, pos in events:
+            root.handle_event(event, pos)
+        t1 = time.perf_counter()
+        ui.animator.advance()
+        root.update()
+        t2 = time.perf_counter()
+        if full_draw:
+            screen.fill(bg_colour)
+            root.draw(screen)
+        else:
+            root.draw_dirty(screen, bg_colour)
+        t3 = time.perf_counter()
+
+        timings['handle_event'].append(t1 - t0)
+        timings['update'].append(t2 - t1)
+        timings['draw'].append(t3 - t2)
+        timings['frame'].append(t3 - t0)
+
+    return {
+        'scene': name,
+        'n': n,
+        'frames': frames,
+        'clicks_per_frame': clicks_per_frame,
+        'full_draw': full_draw,
+        'build_ms': 1000 * build_time,
+        'timings_ms': {k: summarise(v) for k, v in timings.items()},
+    }
+
+
+def print_result(result):
+    print('%s (n=%d, %d frames, build %.1fms)' % (
+        result['scene'], result['n'], result['frames'], result['build_ms']))
+    header = ['phase', 'mean'] + ['p%d' % p for p in PERCENTILES] + ['max']
+    print('  ' + ''.join('%-14s' % h for h in header))
+    for phase in PHASES + ('frame',):
+        stats = result['timings_ms'][phase]
+        print('  %-14s' % phase +
+              ''.join('%-14.3f' % stats[h] for h in header[1:]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scene', choices=sorted(SCENES), action='append',
+                        help='scene to run; may be repeated (default: all)')
+    parser.add_argument('-n', type=int, action='append',
+                        help='number of widgets; may be repeated '
+                             '(default: 100 and 1000)')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--clicks', type=int, default=1,
+                        help='synthetic clicks per frame')
+    parser.add_argument('--full-draw', action='store_true',
+                        help='fill and redraw everything every frame '
+                             'instead of using draw_dirty')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE',
+                        help="write results as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+    if args.json and args.json != '-':
+        # We change directory below.
+        args.json = os.path.abspath(args.json)
+
+    pygame.init()
+    screen = pygame.display.set_mode(WINDOW_SIZE)
+
+    # The ui module loads its icons relative
+    # to the working directory, and needs the
+    # video mode to have been set.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import ui
+
+    results = []
+    for name in args.scene or sorted(SCENES):
+        for n in args.n or [100, 1000]:
+            result = run_scene(ui, screen, name, n, args.frames,
+                               args.clicks, args.full_draw, args.seed)
+            results.append(result)
+            if args.json != '-':
+                print_result(result)
+
+    if args.json:
+        output = {
+            'pygame': pygame.version.ver,
+            'python': sys.version.split()[0],
+            'window_size': WINDOW_SIZE,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+"""
+Saving and loading Simulation checkpoints.
+
+A checkpoint is a single file laid out as:
+  magic      8 bytes, b'ANTCKPT\\0'
+  length     4 bytes, little-endian: the size of
+             this header block, a whole number
+             of pages
+  header     JSON: the ant, the step count, the
+             rule, and where each array is
+  arrays     the grid and any layers, each raw
+             and starting on a page boundary
+
+The grid is stored with its sentinel border, so
+load() can hand the Simulation a numpy.memmap of
+the file itself: opening a huge checkpoint is
+instant and only the pages touched are read.
+Grids of rules with two states may instead be
+bit-packed, which is eight times smaller but
+has to be unpacked (copied) when loaded.
+
+A Checkpointer saves the same run repeatedly,
+writing only the rows of the grid the ant has
+touched since the last save. The changes go
+to a journal first, so a crash at any point
+leaves either the old checkpoint or the new
+one, never a mixture.
+"""
+import os, json, struct, zlib
+import numpy as np
+
+import simulation
+
+
+MAGIC = b'ANTCKPT\0'
+JOURNAL_MAGIC = b'ANTJRNL\0'
+VERSION = 1
+
+# Everything in the file is aligned to this.
+PAGE = 4096
+
+
+def _align(n):
+    return -(-n // PAGE) * PAGE
+
+
+def _fsync_dir(path):
+    """
+    Make a rename or unlink in
+    path's directory durable.
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _layout(sim, packing, pack=True):
+    """
+    Returns (header dict, list of arrays)
+    describing a checkpoint of sim, with
+    the arrays' offsets filled in.
+    If pack is False, a bit-packed grid
+    isn't actually packed, and its array
+    is None.
+    """
+    height, width = sim.grid.shape
+    if packing == 'raw':
+        arrays = [sim._buf]
+        shapes = [sim._buf.shape]
+    elif packing == 'bits':
+        if sim.states > 2:
+            raise ValueError("Only rules with two states can be bit-packed")
+        arrays = [np.packbits(sim.grid, axis=1) if pack else None]
+        shapes = [(height, -(-width // 8))]
+    else:
+        raise ValueError("Unknown packing %r" % packing)
+
+    layers = []
+    for layer in sim.layers:
+        if isinstance(layer, simulation.Patch):
+            layers.append({'type': 'patch', 'x0': layer.rect[0],
+                           'y0': layer.rect[1], 'array': len(arrays)})
+            arrays.append(layer.cells)
+        else:
+            layers.append({'type': 'highway', 'x0': layer.box[0],
+                           'y0': layer.box[1], 'shift': list(layer.shift),
+                           'count': layer.count, 'array': len(arrays)})
+            arrays.append(layer.template)
+    arrays = arrays[:1] + [np.ascontiguousarray(a, np.uint8)
+                           for a in arrays[1:]]
+    shapes += [a.shape for a in arrays[1:]]
+
+    header = {
+        'version': VERSION,
+        'rule': sim.rule,
+        'steps': sim.steps,
+        'x': sim.x,
+        'y': sim.y,
+        'direction': sim.direction,
+        'origin': list(sim.origin),
+        'size': [width, height],
+        'initial_size': list(sim._size),
+        'packing': packing,
+        'detect_highways': sim.detect_highways,
+        'highway_onset': sim.highway_onset,
+        'highway': sim.highway and [sim.highway[0], list(sim.highway[1])],
+        'next_check': sim._next_check,
+        'check_interval': sim._check_interval,
+        'layers': layers,
+        'arrays': [],
+    }
+
+    # The offsets depend on the header size,
+    # which depends on the offsets' digits, so
+    # lay out with a generous guess and repeat.
+    header_size = PAGE
+    while True:
+        offset = header_size
+        header['arrays'] = []
+        for shape in shapes:
+            header['arrays'].append({'offset': offset,
+                                     'shape': list(shape)})
+            offset = _align(offset + int(np.prod(shape)))
+        needed = _align(12 + len(_encode(header)))
+        if needed <= header_size:
+            return header, arrays
+        header_size = needed
+
+
+def _encode(header):
+    return json.dumps(header, sort_keys=True).encode('utf-8')
+
+
+def _header_bytes(header):
+    """
+    The header block, padded out to
+    the offset of the first array.
+    """
+    data = _encode(header)
+    size = header['arrays'][0]['offset']
+    block = MAGIC + struct.pack('<I', size) + data
+    return block + b' ' * (size - len(block))
+
+
+def read_header(path):
+    """
+    Returns the header of a checkpoint as
+    a dict, replaying any journal left by
+    an interrupted save first.
+    """
+    recover(path)
+    with open(path, 'rb') as f:
+        start = f.read(12)
+        if len(start) < 12 or start[:8] != MAGIC:
+            raise ValueError("%s is not a checkpoint" % path)
+        size, = struct.unpack('<I', start[8:])
+        header = json.loads(f.read(size - 12).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise ValueError("%s is from a newer version" % path)
+    return header
+
+
+def _arrays(path, header, mode):
+    return [np.memmap(path, np.uint8, mode, a['offset'], tuple(a['shape']))
+            for a in header['arrays']]
+
+
+def save(sim, path, packing='raw'):
+    """
+    Write a complete checkpoint of sim to
+    path, replacing it atomically.
+    packing is 'raw' or 'bits'.
+    """
+    header, arrays = _layout(sim, packing)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_header_bytes(header))
+        for a, info in zip(arrays, header['arrays']):
+            f.seek(info['offset'])
+            f.write(memoryview(a).cast('B'))
+        f.truncate(_align(f.tell()))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, path)
+    # A journal for the old file
+    # doesn't apply to the new one.
+    try:
+        os.unlink(path + '.journal')
+    except FileNotFoundError:
+        pass
+    _fsync_dir(path)
+
+
+def load(path, mode='c'):
+    """
+    Returns the Simulation saved at path.
+    A raw grid is memory-mapped rather than
+    read: with the default mode 'c', changes
+    made by stepping stay in memory and the
+    file is left alone. Use mode 'r+' to
+    write them through to the file instead.
+    """
+    header = read_header(path)
+    arrays = _arrays(path, header, mode)
+
+    width, height = header['size']
+    sim = simulation.Simulation(header['rule'],
+                                size=tuple(header['initial_size']),
+                                detect_highways=header['detect_highways'])
+
+    if header['packing'] == 'bits':
+        buf = np.full((height + 2, width + 2), simulation.SENTINEL, np.uint8)
+        buf[1:-1, 1:-1] = np.unpackbits(arrays[0], axis=1, count=width)
+        sim._buf = buf
+    else:
+        sim._buf = arrays[0]
+
+    sim.origin = tuple(header['origin'])
+    sim.x, sim.y = header['x'], header['y']
+    sim.direction = header['direction']
+    sim.steps = header['steps']
+    sim.highway_onset = header['highway_onset']
+    if header['highway'] is not None:
+        period, shift = header['highway']
+        sim.highway = (period, tuple(shift))
+    # The rest of the state is private,
+    # but needed to carry on exactly as
+    # the saved run would have.
+    sim._next_check = header['next_check']
+    sim._check_interval = header['check_interval']
+
+    for layer in header['layers']:
+        cells = arrays[layer['array']]
+        if layer['type'] == 'patch':
+            sim.layers.append(simulation.Patch(layer['x0'], layer['y0'],
+                                               cells))
+        else:
+            sim.layers.append(simulation.Highway(
+                layer['x0'], layer['y0'], cells,
+                tuple(layer['shift']), layer['count']))
+    return sim
+
+
+def open_grid(path):
+    """
+    Returns just the grid saved at path, e.g.
+    for viewing, without loading the rest.
+    A raw grid is a read-only memmap.
+    """
+    header = read_header(path)
+    grid = _arrays(path, header, 'r')[0]
+    if header['packing'] == 'bits':
+        return np.unpackbits(grid, axis=1, count=header['size'][0])
+    return grid[1:-1, 1:-1]
+
+
+def _write_journal(path, records):
+    """
+    Write a journal of (offset, data) records,
+    ending with a checksum which marks it as
+    complete, and make it durable.
+    """
+    crc = 0
+    with open(path, 'wb') as f:
+        f.write(JOURNAL_MAGIC + struct.pack('<Q', len(records)))
+        for offset, data in records:
+            head = struct.pack('<QQ', offset, len(data))
+            f.write(head)
+            f.write(data)
+            crc = zlib.crc32(data, zlib.crc32(head, crc))
+        f.write(struct.pack('<I', crc))
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_dir(path)
+
+
+def _read_journal(path):
+    """
+    Returns the records in a journal, or
+    None if it's incomplete or corrupt.
+    """
+    with open(path, 'rb') as f:
+        start = f.read(16)
+        if len(start) < 16 or start[:8] != JOURNAL_MAGIC:
+            return None
+        count, = struct.unpack('<Q', start[8:])
+        records = []
+        crc = 0
+        for i in range(count):
+            head = f.read(16)
+            if len(head) < 16:
+                return None
+            offset, length = struct.unpack('<QQ', head)
+            data = f.read(length)
+            if len(data) < length:
+                return None
+            crc = zlib.crc32(data, zlib.crc32(head, crc))
+            records.append((offset, data))
+        end = f.read(4)
+    if len(end) < 4 or struct.unpack('<I', end)[0] != crc:
+        return None
+    return records
+
+
+def _apply(path, records):
+    with open(path, 'r+b') as f:
+        for offset, data in records:
+            f.seek(offset)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def recover(path):
+    """
+    Finish or discard a save which was
+    interrupted. A complete journal is
+    replayed onto the checkpoint; anything
+    else means the checkpoint itself was
+    never touched, so it's thrown away.
+    """
+    journal = path + '.journal'
+    if not os.path.exists(journal):
+        return
+    records = _read_journal(journal)
+    if records:
+        _apply(path, records)
+    os.unlink(journal)
+    _fsync_dir(journal)
+
+
+class Checkpointer:
+    """
+    Saves one run to the same file over
+    and over, writing only what changed.
+
+    It uses (and resets) the Simulation's
+    touched rect to find what changed, so
+    after changing cells by hand, add them
+    to it, or set full on the next save.
+    """
+    def __init__(self, path, packing='raw'):
+        """
+        Initialises the checkpointer.
+        packing is 'raw' or 'bits'.
+        """
+        self.path = path
+        self.packing = packing
+
+        # How many bytes the last save wrote
+        self.written = 0
+
+        # The grid buffer and layers as of the
+        # last save, to tell whether they've
+        # been replaced since.
+        self._buf = None
+        self._layers = []
+
+    def _old_layout(self):
+        """
+        The header of the existing file,
+        or None if there isn't a usable one.
+        """
+        try:
+            return read_header(self.path)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, sim, full=False):
+        """
+        Checkpoint sim. If the grid hasn't been
+        replaced (by growing or jumping along a
+        highway) since the last save, only the
+        rows the ant has touched are written,
+        without reading the rest of the grid.
+        If full is True, everything is written.
+        """
+        header, arrays = _layout(sim, self.packing, pack=False)
+        replaced = sim._buf is not self._buf or \
+            len(sim.layers) != len(self._layers) or \
+            any(a is not b for a, b in zip(sim.layers, self._layers))
+        old = None if full or replaced else self._old_layout()
+        if old is None or old['arrays'] != header['arrays']:
+            # Start a new file.
+            save(sim, self.path, self.packing)
+            self.written = header['arrays'][-1]['offset'] + \
+                int(np.prod(header['arrays'][-1]['shape']))
+            self._buf = sim._buf
+            self._layers = list(sim.layers)
+            sim.touched = None
+            return
+
+        records = [(0, _header_bytes(header))]
+        if sim.touched is not None:
+            records.extend(self._rows(sim, sim.touched,
+                                      header['arrays'][0]['offset']))
+
+        _write_journal(self.path + '.journal', records)
+        _apply(self.path, records)
+        os.unlink(self.path + '.journal')
+        _fsync_dir(self.path)
+        self.written = sum(len(data) for offset, data in records)
+        sim.touched = None
+
+    def _rows(self, sim, rect, offset):
+        """
+        Yields (file offset, data) for each
+        row of the grid array within rect, in
+        world coordinates, given the array's
+        offset in the file.
+        """
+        height, width = sim.grid.shape
+        ox, oy = sim.origin
+        left, top = max(0, rect[0] - ox), max(0, rect[1] - oy)
+        right, bottom = min(width, rect[2] - ox), min(height, rect[3] - oy)
+        if left >= right or top >= bottom:
+            return
+
+        if self.packing == 'bits':
+            # Whole bytes, of eight cells each
+            left, right = left // 8, -(-right // 8)
+            stride = -(-width // 8)
+            rows = np.packbits(sim.grid[top:bottom, left*8:right*8], axis=1)
+        else:
+            # The array has the sentinel border
+            left, right, top, bottom = left + 1, right + 1, top + 1, bottom + 1
+            stride = width + 2
+            rows = sim._buf[top:bottom, left:right]
+
+        for y, row in enumerate(rows, top):
+            yield (offset + y * stride + left, row.tobytes())
@@ -0,0 +1,240 @@
+"""
+Exporting frames to PNG image sequences
+without stalling whoever produces them.
+
+Frames (rendered surfaces, or raw grids of
+cell states) are copied into a bounded queue,
+which a writer thread or process drains to
+numbered PNG files. When the writer falls
+behind, the policy decides whether to wait for
+it ('block') or to drop frames ('drop' the new
+frame, or 'drop-oldest').
+
+Run as a script, it renders a simulation
+headlessly, as fast as the writer allows, e.g.:
+    python export.py RL --steps-per-frame 200 --frames 500 -o frames
+    ffmpeg -i frames/frame%06d.png run.mp4
+"""
+import os, sys, time, queue, argparse, threading
+import multiprocessing
+
+# Keep stdout clean. Nothing here
+# needs a display to be set up.
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy as np
+import pygame
+
+import simulation
+
+
+POLICIES = ('block', 'drop', 'drop-oldest')
+
+# Colours for cell states 0, 1, ...
+PALETTE = ((255,255,255), (0,0,0), (220,50,47), (38,139,210),
+           (133,153,0), (211,54,130), (181,137,0), (42,161,152))
+
+
+def _to_surface(item, palette, scale):
+    """
+    Turns a queued item back into a surface.
+    """
+    kind, payload = item
+    if kind == 'rgb':
+        size, data = payload
+        return pygame.image.frombuffer(data, size, 'RGB')
+
+    rgb = np.asarray(palette, np.uint8).take(payload, axis=0, mode='wrap')
+    if scale > 1:
+        rgb = rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+    # surfarray is indexed [x, y]
+    return pygame.surfarray.make_surface(rgb.transpose(1, 0, 2))
+
+
+def _writer(frames, directory, pattern, palette, scale, written):
+    """
+    Saves frames from the queue, in order,
+    until it gets None.
+    """
+    while True:
+        item = frames.get()
+        if item is None:
+            return
+        path = os.path.join(directory, pattern % written.value)
+        pygame.image.save(_to_surface(item, palette, scale), path)
+        # Only this writer changes the count.
+        written.value += 1
+
+
+class _Counter:
+    """
+    Stands in for a multiprocessing.Value
+    when the writer is a thread.
+    """
+    def __init__(self):
+        self.value = 0
+
+
+class FrameExporter:
+    """
+    Writes frames to a directory as a PNG
+    sequence, from a background writer.
+    """
+    def __init__(self, directory, **kwargs):
+        """
+        Initialises the exporter and
+        starts its writer.
+        Allows the following keyword arguments:
+          pattern: The file name pattern, given
+                   the frame number.
+                   Default 'frame%06d.png'.
+          max_queue: How many frames may wait
+                     to be written. Default 32.
+          policy: What to do when the queue is
+                  full: 'block', 'drop' or
+                  'drop-oldest'. Default 'block'.
+          palette: Colours for the cell states
+                   of grids. Of format
+                   [(red, green, blue), ...].
+          scale: The size of a grid cell
+                 in pixels. Default 1.
+          process: Whether to write from a
+                   separate process rather than
+                   a thread, so encoding PNGs
+                   doesn't compete for the GIL.
+                   Default False.
+        """
+        self.directory = directory
+        self.policy = kwargs.get('policy', 'block')
+        if self.policy not in POLICIES:
+            raise ValueError("Unknown policy %r" % self.policy)
+
+        pattern = kwargs.get('pattern', 'frame%06d.png')
+        max_queue = kwargs.get('max_queue', 32)
+        palette = tuple(kwargs.get('palette', PALETTE))
+        scale = kwargs.get('scale', 1)
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Frames given to submit, and
+        # how many of them were dropped.
+        self.submitted = 0
+        self.dropped = 0
+
+        args = (directory, pattern, palette, scale)
+        if kwargs.get('process', False):
+            self._frames = multiprocessing.Queue(max_queue)
+            self._written = multiprocessing.Value('q', 0)
+            self._worker = multiprocessing.Process(
+                target=_writer, args=(self._frames,) + args + (self._written,),
+                daemon=True)
+        else:
+            self._frames = queue.Queue(max_queue)
+            self._written = _Counter()
+            self._worker = threading.Thread(
+                target=_writer, args=(self._frames,) + args + (self._written,),
+                daemon=True)
+        self._worker.start()
+
+    @property
+    def written(self):
+        """
+        The number of frames saved so far.
+        """
+        return self._written.value
+
+    def submit(self, frame):
+        """
+        Queue a copy of a frame, which is either
+        a pygame Surface or a 2D array of cell
+        states indexed [y, x].
+        Returns whether the frame was queued.
+        """
+        if isinstance(frame, pygame.Surface):
+            item = ('rgb', (frame.get_size(),
+                            pygame.image.tobytes(frame, 'RGB')))
+        else:
+            item = ('grid', np.array(frame, np.uint8))
+        self.submitted += 1
+
+        if self.policy == 'block':
+            self._frames.put(item)
+            return True
+
+        try:
+            self._frames.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == 'drop':
+            self.dropped += 1
+            return False
+
+        # Make room by dropping the oldest frame.
+        # The writer may take it first, in which
+        # case there's room anyway.
+        try:
+            self._frames.get_nowait()
+            self.dropped += 1
+        except queue.Empty:
+            pass
+        try:
+            self._frames.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        """
+        Wait for every queued frame
+        to be written.
+        """
+        self._frames.put(None)
+        self._worker.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render a simulation to a PNG sequence headlessly.')
+    parser.add_argument('rule', nargs='?', default='RL')
+    parser.add_argument('-o', '--output', default='frames',
+                        help='directory to write to')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--steps-per-frame', type=int, default=100)
+    parser.add_argument('--size', type=int, nargs=2, default=(128, 128),
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='the region shown, in cells, '
+                             'centered on the start')
+    parser.add_argument('--scale', type=int, default=4,
+                        help='pixels per cell')
+    parser.add_argument('--policy', choices=POLICIES, default='block')
+    parser.add_argument('--max-queue', type=int, default=32)
+    parser.add_argument('--process', action='store_true',
+                        help='write from a separate process')
+    args = parser.parse_args(argv)
+
+    width, height = args.size
+    sim = simulation.Simulation(args.rule, size=(width, height))
+    left, top = sim.x - width // 2, sim.y - height // 2
+
+    exporter = FrameExporter(args.output, policy=args.policy,
+                             max_queue=args.max_queue, scale=args.scale,
+                             process=args.process)
+
+    start = time.perf_counter()
+    for f in range(args.frames):
+        exporter.submit(sim.region(left, top, left + width, top + height))
+        sim.step(args.steps_per_frame)
+    exporter.close()
+    elapsed = time.perf_counter() - start
+
+    print('%d frames written, %d dropped, in %.2fs (%.1f fps)' % (
+        exporter.written, exporter.dropped, elapsed,
+        exporter.submitted / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
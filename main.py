@@ -4,83 +4,317 @@ import pygame, sys
 WINDOW_SIZE = (500,500)
 FPS = 60.0
 
+# Animations advance in steps of this many
+# seconds of real time, however fast (or
+# slowly) frames are actually drawn.
+TIMESTEP = 1 / 120
 
-pygame.init()
+# An ant rule to run in a panel beside
+# the scene, or None to not run one.
+SIM_RULE = None
+# The fraction of each frame's time spent
+# stepping the simulation. It runs as many
+# steps as fit, so it goes as fast as the
+# machine allows rather than a fixed number
+# of steps per frame.
+SIM_BUDGET = 0.5
+# Whether to run the simulation in a separate
+# process, which steps it as fast as it can
+# without taking any time from the frames.
+SIM_PROCESS = True
+# The number of steps run between
+# checks of the time (or, in a separate
+# process, between publishing the grid). Highways are only
+# looked for (and skipped) in runs of at
+# least 4*simulation.MAX_PERIOD steps.
+SIM_CHUNK = 20000
 
-# Icon must be set before screen
-# has been initialised
-icon = pygame.image.load("icons/icon.png")
-pygame.display.set_icon(icon)
+# When nothing is animating, block waiting
+# for events instead of redrawing every frame.
+EVENT_DRIVEN = True
+# The longest we will sleep for while idle,
+# in milliseconds.
+IDLE_TIMEOUT = 1000
 
-screen = pygame.display.set_mode(WINDOW_SIZE)
-clock  = pygame.time.Clock()
+# Record how long each widget takes.
+# Press F3 to show the results.
+PROFILE = False
+# Where to save the profiling data on
+# exit, or None to not save it.
+PROFILE_DUMP = None
 
-pygame.display.set_caption('Langton\'s Ant', 'Langton\'s Ant')
+# Save every frame to this directory as a
+# PNG sequence, or None to not save them.
+EXPORT_DIR = None
+# What to do when frames come faster than
+# they can be saved: 'block', 'drop' or
+# 'drop-oldest'.
+EXPORT_POLICY = 'drop'
 
 
-# The ui module requires pygame to be initialised,
-# and the video mode to be set, since it calls
-# convert_alpha on some surfaces to improve speed.
-import ui
+def main():
+    pygame.init()
 
+    # Icon must be set before screen
+    # has been initialised
+    icon = pygame.image.load("icons/icon.png")
+    pygame.display.set_icon(icon)
 
-# A function to get the FPS
-def _temp_get_fps():
-    if clock.get_fps():
-        return clock.get_fps()
-    # Prevent get_fps from
-    # ever returning 0.
-    return FPS
+    if SIM_RULE:
+        # The simulation goes on the right.
+        screen = pygame.display.set_mode((WINDOW_SIZE[0]*2, WINDOW_SIZE[1]))
+    else:
+        screen = pygame.display.set_mode(WINDOW_SIZE)
+    clock  = pygame.time.Clock()
 
-ui.get_fps = _temp_get_fps
+    pygame.display.set_caption('Langton\'s Ant', 'Langton\'s Ant')
 
+    # The ui module requires pygame to be initialised,
+    # and the video mode to be set, since it calls
+    # convert_alpha on some surfaces to improve speed.
+    import ui
 
-# A test scene
-screenContainer = ui.UnboundedContainer()
+    # A function to get the FPS
+    def _temp_get_fps():
+        if clock.get_fps():
+            return clock.get_fps()
+        # Prevent get_fps from
+        # ever returning 0.
+        return FPS
 
-def calc(box = None, mpos = None):
-    v = 0
-    for c in screenContainer.children[:0:-1]:
-        v *= 2
-        v += c.checked
-    screenContainer.children[0].text = str(v)
+    ui.get_fps = _temp_get_fps
 
-p = [450,450]
-def add_checkbox(btn, mpos):    
-    if p[0] < 0:
-        p[1] -= 50
-        p[0] = 450
-    if p[1] < 100:
-        return
-    screenContainer.children.append(ui.Checkbox(
-        p,
-        colour=(p[0]*255//500,p[1]*255//500,(p[0]-p[1]+500)*127//500),
-        onchange=calc))
-    p[0] -= 50
-    
-    calc()
+    # A test scene
+    screenContainer = ui.UnboundedContainer()
 
-screenContainer.children.append(ui.Button((0,0), size=(500,100), text='hello world', onclick=add_checkbox))
+    # The checkboxes are the bits of a binary number,
+    # filling up from the bottom right like digits.
+    # The number is kept up to date a bit at a time
+    # as they change, rather than by adding them all
+    # up again.
+    value = 0
+    bits = {} # checkbox -> its bit
 
+    def set_bit(box):
+        nonlocal value
+        if box.checked:
+            value |= bits[box]
+        else:
+            value &= ~bits[box]
 
-while 1:
-    for event in pygame.event.get():
-        if (event.type == pygame.KEYDOWN and
-            event.key == pygame.K_ESCAPE) or \
-           event.type == pygame.QUIT:
-            pygame.quit() # IDLE friendly :)
-            sys.exit(0)
+    def show_value():
+        screenContainer.children[0].text = str(value)
+
+    def on_toggle(box, mpos):
+        set_bit(box)
+        show_value()
+
+    def on_batch(container, changed):
+        # Only the checkboxes which changed
+        for box in changed:
+            set_bit(box)
+        show_value()
+
+    def set_value(v):
+        """
+        Check the checkboxes to show v, updating
+        the number once at the end rather than
+        for every checkbox.
+        """
+        with checkboxes.batch():
+            for box, bit in bits.items():
+                box.checked = v & bit
+
+    checkboxes = ui.Container((0,100), size=(500,400),
+                              layout=ui.Grid(10, cell_size=(50,50),
+                                             reverse=True),
+                              onchange=on_batch)
+
+    def add_checkbox(btn, mpos):    
+        if len(checkboxes.children) >= 80:
+            return
+        # The grid places it, so only the new
+        # checkbox needs laying out.
+        box = ui.Checkbox((0,0), onchange=on_toggle)
+        bits[box] = 1 << len(bits)
+        checkboxes.children.append(box)
+        checkboxes.relayout()
         
-        screenContainer.handle_event(
-            event, pygame.mouse.get_pos()
-        )
-                
-    screen.fill(pygame.colordict.THECOLORS['white'])
+        # Colour it by where it ended up.
+        x, y = box.pos
+        y += 100
+        box.colour = [x*255//500, y*255//500, (x-y+500)*127//500]
+        
+        show_value()
+
+    screenContainer.children.append(ui.Button((0,0), size=(500,100), text='hello world', onclick=add_checkbox))
+    screenContainer.children.append(checkboxes)
 
-    
-    screenContainer.update()
-    screenContainer.draw(screen)
-    
+    # Everything drawn on the screen
+    root = ui.UnboundedContainer(children=[screenContainer])
+
+    profiler = ui.Profiler()
+    if PROFILE:
+        profiler.enable()
+        root.children.append(ui.ProfilerOverlay((0,0), profiler))
+
+    # Animation (and the simulation) run
+    # on real time, not on frames.
+    scheduler = ui.Scheduler(TIMESTEP)
+    scheduler.step_tasks.append(ui.animator.advance)
+
+    sim = None
+    worker = None
+    if SIM_RULE and SIM_PROCESS:
+        import numpy, background
+        
+        size = (WINDOW_SIZE[0] // 4, WINDOW_SIZE[1] // 4)
+        worker = background.BackgroundSimulation(SIM_RULE, size=size,
+                                                 chunk=SIM_CHUNK)
+        # Shows the worker's latest grid,
+        # once it has published one.
+        simview = ui.GridView((WINDOW_SIZE[0], 0),
+                              numpy.zeros(size[::-1], numpy.uint8), cell_size=4)
+        root.children.append(simview)
+        # The number of the frame shown
+        shown = None
+    elif SIM_RULE:
+        import simulation
+        
+        sim = simulation.Simulation(SIM_RULE, detect_highways=True)
+        viewport = ui.GridViewport((WINDOW_SIZE[0], 0), WINDOW_SIZE,
+                                   sim.grid, origin=sim.origin, zoom=4)
+        root.children.append(viewport)
+        
+        def centre_on_ant():
+            viewport.view = [sim.x - WINDOW_SIZE[0] / 2 / viewport.zoom,
+                             sim.y - WINDOW_SIZE[1] / 2 / viewport.zoom]
+            viewport.mark_dirty()
+        centre_on_ant()
+        
+        scheduler.spare_tasks.append(lambda: sim.step(SIM_CHUNK))
+        
+        def show_sim():
+            """
+            Tell the viewport which cells the
+            ant changed since the last frame.
+            """
+            touched, sim.touched = sim.touched, None
+            if sim.grid.base is not viewport.grid.base:
+                # The grid grew, or the ant jumped
+                # along a highway, so the grid is
+                # a new array.
+                viewport.set_grid(sim.grid, sim.origin)
+                zoom = viewport.zoom
+                if not viewport.get_rect().collidepoint(
+                        viewport.pos[0] + (sim.x - viewport.view[0]) * zoom,
+                        viewport.pos[1] + (sim.y - viewport.view[1]) * zoom):
+                    centre_on_ant()
+                return
+            
+            if touched:
+                left, top, right, bottom = touched
+                ox, oy = sim.origin
+                viewport.mark_cells(left - ox, top - oy,
+                                    right - ox, bottom - oy)
+
+    exporter = None
+    if EXPORT_DIR:
+        import export
+        # Frames are saved from another thread,
+        # so the loop doesn't wait on the disk.
+        exporter = export.FrameExporter(EXPORT_DIR, policy=EXPORT_POLICY)
+
+    # Everything after this point is drawn
+    # incrementally, so start from a blank screen.
+    screen.fill(pygame.colordict.THECOLORS['white'])
     pygame.display.flip()
-    
-    clock.tick(FPS)
+
+    # Events received while waiting
+    # for something to happen
+    pending = []
+
+    while 1:
+        profiler.start_frame()
+        
+        for event in pending + pygame.event.get():
+            if (event.type == pygame.KEYDOWN and
+                event.key == pygame.K_ESCAPE) or \
+               event.type == pygame.QUIT:
+                if PROFILE_DUMP:
+                    profiler.dump(PROFILE_DUMP)
+                if exporter:
+                    exporter.close()
+                if worker:
+                    worker.close()
+                pygame.quit() # IDLE friendly :)
+                sys.exit(0)
+            
+            if event.type == pygame.KEYDOWN and \
+               event.key == pygame.K_BACKSPACE:
+                # Clear all the checkboxes at once.
+                set_value(0)
+            
+            root.handle_event(
+                event, pygame.mouse.get_pos()
+            )
+                    
+        # Catch up on the timesteps since the
+        # last frame, and spend some of the
+        # frame's time on the simulation.
+        alpha = scheduler.run(SIM_BUDGET / FPS)
+        # Draw animations part way between
+        # their last two steps, so they stay
+        # smooth whatever the frame rate.
+        ui.animator.interpolate(alpha)
+        
+        if sim:
+            show_sim()
+        if worker:
+            frame = worker.latest()
+            if frame and frame.number != shown:
+                # No copy: the view draws straight
+                # from the worker's shared memory.
+                # (A new array, so it's redrawn.)
+                simview.grid = frame.cells
+                shown = frame.number
+        
+        root.update()
+        
+        # Only redraw (and send to the display)
+        # the regions which actually changed.
+        rects = root.draw_dirty(
+            screen, pygame.colordict.THECOLORS['white']
+        )
+        if rects:
+            pygame.display.update(rects)
+        
+        if exporter:
+            exporter.submit(screen)
+        
+        profiler.end_frame()
+        
+        clock.tick(FPS)
+        
+        pending = []
+        if EVENT_DRIVEN and not root.is_animating() \
+           and not (sim or worker or exporter):
+            # Nothing on screen will change until
+            # the user does something, so sleep.
+            # (Not while exporting, which would
+            # leave gaps in the exported frames.)
+            event = pygame.event.wait(IDLE_TIMEOUT)
+            if event.type != pygame.NOEVENT:
+                pending.append(event)
+            
+            # The time spent asleep would otherwise
+            # drag down the measured frame rate and
+            # be caught up on as a burst of steps.
+            clock = pygame.time.Clock()
+            scheduler.reset()
+
+
+if __name__ == '__main__':
+    # Not on import, e.g. when a worker process
+    # started by spawning imports this module.
+    main()
@@ -0,0 +1,1452 @@
+"""
+The Langton's Ant simulation engine.
+
+The world is a grid of cell states stored in
+a uint8 NumPy array, which grows on demand as
+the ant walks off its edge. The ant turns
+according to a rule string with one letter per
+cell state, e.g. "RL" for the classic ant:
+  R: turn right
+  L: turn left
+  N: no turn
+  U: u-turn
+On each step the ant turns according to the
+state of its cell, advances that cell to the
+next state and moves forward one cell.
+
+Many ants eventually build a 'highway': a
+pattern that repeats every P steps, shifted
+along by a fixed displacement. When highway
+detection is on, the simulation recognises
+these and jumps over whole periods at once.
+The cells the ant leaves behind are then kept
+as layers (see Patch and Highway) underneath
+the dense grid, rather than in one huge array.
+
+This module doesn't depend on pygame, so it
+can be used without a display.
+"""
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Directions, clockwise from up.
+# y increases downwards, as on screen.
+UP, RIGHT, DOWN, LEFT = range(4)
+DX = (0, 1, 0, -1)
+DY = (-1, 0, 1, 0)
+
+TURNS = {'N': 0, 'R': 1, 'U': 2, 'L': 3}
+
+# The value of the cells bordering the
+# grid. Reading one means the ant has
+# walked off the edge.
+SENTINEL = 255
+
+# The smallest amount the grid
+# grows by at a time.
+MIN_GROWTH = 16
+
+# The longest highway period looked for.
+MAX_PERIOD = 4096
+# The fewest periods worth jumping over;
+# shorter jumps are just simulated.
+MIN_JUMP = 16
+# The most boxes checked for being empty
+# ahead of a highway in a single jump.
+MAX_SWEEP = 20000
+# Steps between attempts to find a highway.
+# This doubles after each failed attempt,
+# up to the maximum.
+CHECK_INTERVAL = 2 * MAX_PERIOD
+MAX_CHECK_INTERVAL = 1 << 20
+
+# The ant is run this many steps at a time,
+# so that the area it has changed can be
+# bounded without looking at every step.
+TRACK_STEPS = 256
+
+# The width and height of a ChunkedGrid chunk
+CHUNK_SIZE = 256
+# How many chunks a ChunkedGrid keeps in
+# memory before spilling them to disk.
+MAX_CHUNKS = 1024
+
+
+def parse_rule(rule):
+    """
+    Converts a rule string into a list
+    of turns, one per cell state, where
+    each turn is the number of clockwise
+    quarter turns.
+    Raises ValueError for invalid rules.
+    """
+    rule = rule.upper()
+    if not 1 <= len(rule) < SENTINEL:
+        raise ValueError("Rules must have between 1 and %d states"
+                         % (SENTINEL - 1))
+    try:
+        return [TURNS[c] for c in rule]
+    except KeyError as e:
+        raise ValueError("Unknown turn %r in rule %r" % (e.args[0], rule))
+
+
+def _tables(turns):
+    """
+    Returns lookup tables (turn, after),
+    indexed by cell state, for the main loop.
+    The sentinel doesn't turn the ant, and
+    its 'next state' of None makes writing
+    it raise a TypeError, so walking off the
+    grid costs nothing until it happens.
+    """
+    states = len(turns)
+    turn = list(turns) + [0] * (256 - states)
+    after = list(range(1, states)) + [0] + [None] * (256 - states)
+    return turn, after
+
+
+def _walk(buf, i, d, n, turn, after, record=None, offset=0):
+    """
+    Run up to n steps of an ant at flat index i
+    of buf, a 2D array with a sentinel border,
+    facing direction d, stopping early if the
+    ant reaches the border.
+    If record is given, the state read on
+    each step is written to it from offset.
+    Returns (steps run, index, direction).
+    """
+    stride = buf.shape[1]
+    offset_of = [-stride, 1, stride, -1]
+
+    # memoryview indexing is much faster
+    # than indexing the array itself.
+    cells = memoryview(buf.reshape(-1))
+
+    done = n
+    try:
+        if record is None:
+            for s in range(n):
+                c = cells[i]
+                d = (d + turn[c]) & 3
+                cells[i] = after[c]
+                i += offset_of[d]
+        else:
+            for s in range(n):
+                c = cells[i]
+                d = (d + turn[c]) & 3
+                cells[i] = after[c]
+                record[offset + s] = c
+                i += offset_of[d]
+    except TypeError:
+        # We hit the sentinel at index i,
+        # without completing step s.
+        done = s
+
+    return done, i, d
+
+
+def _intersect(a, b):
+    """
+    The intersection of two (left, top,
+    right, bottom) rects, or None.
+    """
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    if left < right and top < bottom:
+        return (left, top, right, bottom)
+    return None
+
+def _union(a, b):
+    """
+    The bounding box of two (left, top,
+    right, bottom) rects, either of which
+    may be None.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]),
+            max(a[2], b[2]), max(a[3], b[3]))
+
+def _nonzero_box(array, x0=0, y0=0):
+    """
+    The bounding box of the non-zero
+    cells of a 2D array whose [0, 0]
+    is at (x0, y0), or None.
+    """
+    cols = np.flatnonzero(array.any(axis=0))
+    if not len(cols):
+        return None
+    rows = np.flatnonzero(array.any(axis=1))
+    return (x0 + int(cols[0]), y0 + int(rows[0]),
+            x0 + int(cols[-1]) + 1, y0 + int(rows[-1]) + 1)
+
+def _axis_range(b0, b1, s, t0, t1, lo, hi):
+    """
+    The range of m in [lo, hi] for which
+    [b0 + m*s, b1 + m*s) overlaps [t0, t1),
+    as an inclusive (first, last) pair.
+    The range may be empty (first > last).
+    """
+    if s == 0:
+        return (lo, hi) if b0 < t1 and b1 > t0 else (lo, lo - 1)
+    if s < 0:
+        # Mirror everything so s is positive
+        return _axis_range(1 - b1, 1 - b0, -s, 1 - t1, 1 - t0, lo, hi)
+    return (max(lo, (t0 - b1) // s + 1), min(hi, (t1 - b0 - 1) // s))
+
+def _box_range(box, shift, target, lo, hi):
+    """
+    The range of m in [lo, hi] for which
+    box shifted by m*shift overlaps the
+    target rect, as an inclusive pair.
+    """
+    xlo, xhi = _axis_range(box[0], box[2], shift[0],
+                           target[0], target[2], lo, hi)
+    ylo, yhi = _axis_range(box[1], box[3], shift[1],
+                           target[1], target[3], lo, hi)
+    return (max(xlo, ylo), min(xhi, yhi))
+
+
+class Patch:
+    """
+    A layer holding a fixed rectangle of
+    cells, e.g. the grid as it was when the
+    ant set off along a highway.
+    """
+    def __init__(self, x0, y0, cells):
+        self.cells = cells
+        height, width = cells.shape
+        self.rect = (x0, y0, x0 + width, y0 + height)
+
+    def paint(self, array, ax, ay, mask=None):
+        """
+        Copy our cells onto the part of array
+        (whose [0, 0] is at world position
+        (ax, ay)) that we overlap.
+        If mask is given, it is set to True
+        wherever we painted.
+        """
+        height, width = array.shape
+        overlap = _intersect(self.rect, (ax, ay, ax + width, ay + height))
+        if overlap is None:
+            return
+        left, top, right, bottom = overlap
+        x0, y0 = self.rect[:2]
+        array[top - ay:bottom - ay, left - ax:right - ax] = \
+            self.cells[top - y0:bottom - y0, left - x0:right - x0]
+        if mask is not None:
+            mask[top - ay:bottom - ay, left - ax:right - ax] = True
+
+    def visible(self, covered, upper):
+        """
+        Returns (population, bounding box) of
+        our non-zero cells which aren't hidden
+        by the covered rects or by the given
+        layers above us.
+        """
+        nonzero = self.cells != 0
+        x0, y0 = self.rect[:2]
+
+        hidden = np.zeros(nonzero.shape, bool)
+        for layer in upper:
+            layer.paint(np.empty(nonzero.shape, np.uint8), x0, y0, hidden)
+        for rect in covered:
+            overlap = _intersect(self.rect, rect)
+            if overlap is not None:
+                left, top, right, bottom = overlap
+                hidden[top - y0:bottom - y0, left - x0:right - x0] = True
+
+        nonzero &= ~hidden
+        return int(np.count_nonzero(nonzero)), _nonzero_box(nonzero, x0, y0)
+
+
+class Highway:
+    """
+    A layer holding the trail of an ant on a
+    highway. template is the block of cells
+    the ant passed through during one period,
+    as they were at the end of it, with its
+    top left at (x0, y0). Each later period is
+    the same block shifted by m*shift, for
+    m = 1..count, painted in order.
+    """
+    def __init__(self, x0, y0, template, shift, count):
+        self.template = template
+        self.shift = shift
+        self.count = count
+
+        height, width = template.shape
+        self.box = (x0, y0, x0 + width, y0 + height)
+        self.rect = _union(self._box_at(1), self._box_at(count))
+
+        # The cells of the template which no
+        # later period overwrites: the part of
+        # the box not covered by the next box.
+        trail = np.ones(template.shape, bool)
+        overlap = _intersect(self.box, self._box_at(1))
+        if overlap is not None:
+            left, top, right, bottom = overlap
+            trail[top - y0:bottom - y0, left - x0:right - x0] = False
+        self._trail = trail & (template != 0)
+        self._trail_count = int(np.count_nonzero(self._trail))
+        self._trail_box = _nonzero_box(self._trail)
+
+    def _box_at(self, m):
+        sx, sy = self.shift
+        return (self.box[0] + m*sx, self.box[1] + m*sy,
+                self.box[2] + m*sx, self.box[3] + m*sy)
+
+    def paint(self, array, ax, ay, mask=None):
+        """
+        Paint every period overlapping array
+        (whose [0, 0] is at world position
+        (ax, ay)), in order.
+        If mask is given, it is set to True
+        wherever we painted.
+        """
+        height, width = array.shape
+        target = (ax, ay, ax + width, ay + height)
+        first, last = _box_range(self.box, self.shift, target, 1, self.count)
+
+        x0, y0 = self.box[:2]
+        for m in range(first, last + 1):
+            box = self._box_at(m)
+            left, top, right, bottom = _intersect(box, target)
+            bx, by = box[:2]
+            array[top - ay:bottom - ay, left - ax:right - ax] = \
+                self.template[top - by:bottom - by, left - bx:right - bx]
+            if mask is not None:
+                mask[top - ay:bottom - ay, left - ax:right - ax] = True
+
+    def visible(self, covered, upper):
+        """
+        Returns (population, bounding box) of
+        our non-zero cells which aren't hidden
+        by the covered rects.
+
+        Layers above a highway never hide its
+        non-zero cells except inside rects that
+        are already covered, because the space
+        ahead of a highway is checked to be empty
+        before it's created, so upper is unused.
+        """
+        # Periods 1..count-1 each leave behind a
+        # trail; the last period leaves its whole
+        # template. Trails are handled analytically,
+        # except where they meet a covered rect.
+        population = 0
+        box = None
+
+        trail_box = None
+        if self._trail_box is not None:
+            tx0, ty0, tx1, ty1 = self._trail_box
+            x0, y0 = self.box[:2]
+            trail_box = (x0 + tx0, y0 + ty0, x0 + tx1, y0 + ty1)
+
+        special = [self.count]
+        if trail_box is not None:
+            for rect in covered:
+                first, last = _box_range(trail_box, self.shift, rect,
+                                         1, self.count - 1)
+                special.extend(range(first, last + 1))
+        special = sorted(set(special))
+
+        # Runs of periods with untouched trails
+        if trail_box is not None:
+            start = 1
+            sx, sy = self.shift
+            for m in special + [self.count]:
+                if m > start:
+                    # Trails for periods start..m-1
+                    population += self._trail_count * (m - start)
+                    box = _union(box, (trail_box[0] + min(start*sx, (m-1)*sx),
+                                       trail_box[1] + min(start*sy, (m-1)*sy),
+                                       trail_box[2] + max(start*sx, (m-1)*sx),
+                                       trail_box[3] + max(start*sy, (m-1)*sy)))
+                start = max(start, m + 1)
+
+        # Periods whose cells need checking one by one
+        for m in special:
+            cells = self.template != 0
+            if m != self.count:
+                cells = cells & self._trail
+            bx, by = self._box_at(m)[:2]
+            cells = cells.copy()
+            for rect in covered:
+                overlap = _intersect(self._box_at(m), rect)
+                if overlap is not None:
+                    left, top, right, bottom = overlap
+                    cells[top - by:bottom - by, left - bx:right - bx] = False
+            population += int(np.count_nonzero(cells))
+            box = _union(box, _nonzero_box(cells, bx, by))
+
+        return population, box
+
+
+class Simulation:
+    """
+    A single ant on a growable grid.
+
+    The ant's position (x, y) is in world
+    coordinates, which stay fixed as the grid
+    grows; origin is the world position of
+    grid[0, 0]. grid is indexed [row, column],
+    i.e. [y, x].
+
+    With detect_highways, step() recognises
+    highways and skips over them. The grid then
+    only covers the area around the ant, and
+    region(), cell(), population() and
+    bounding_box() should be used to look at
+    the rest of the world.
+    """
+    def __init__(self, rule='RL', size=(64, 64), pos=None,
+                 direction=UP, detect_highways=False):
+        """
+        Initialises the simulation.
+        size is the initial (width, height)
+        of the grid, and pos the ant's
+        starting position within it. By
+        default the ant starts in the center.
+        """
+        self.rule = rule.upper()
+        self._turns = parse_rule(rule)
+
+        width, height = size
+        self._size = size
+
+        # One cell of sentinel border on each side.
+        self._buf = np.full((height + 2, width + 2), SENTINEL, np.uint8)
+        self._buf[1:-1, 1:-1] = 0
+        self.origin = (0, 0)
+
+        if pos is None:
+            pos = (width // 2, height // 2)
+        self.x, self.y = pos
+        self.direction = direction
+
+        self.steps = 0
+
+        self.detect_highways = detect_highways
+        # Patches and Highways under the grid,
+        # from the bottom up.
+        self.layers = []
+        # The step the first highway found started
+        # on, if any: from then on, the states the
+        # ant read repeated every period.
+        self.highway_onset = None
+        # (period, shift) of the last highway found
+        self.highway = None
+        # A rect (left, top, right, bottom) of world
+        # coordinates covering every cell changed by
+        # stepping since this was last set to None,
+        # or None. It may be a little bigger than
+        # needed. Cells changed through grid by hand
+        # aren't included.
+        self.touched = None
+
+        self._next_check = 0
+        self._check_interval = CHECK_INTERVAL
+        # The step the last jump landed on
+        self._jumped_to = None
+
+    @property
+    def grid(self):
+        """
+        The grid of cell states. This is a view,
+        so it can be edited in place, but it is
+        replaced whenever the grid grows.
+        """
+        return self._buf[1:-1, 1:-1]
+
+    @property
+    def states(self):
+        """
+        The number of cell states.
+        """
+        return len(self._turns)
+
+    def _grid_rect(self):
+        height, width = self.grid.shape
+        return (self.origin[0], self.origin[1],
+                self.origin[0] + width, self.origin[1] + height)
+
+    def region(self, left, top, right, bottom):
+        """
+        Returns a new array of the cell states
+        in the given rect of world coordinates
+        (right and bottom exclusive), including
+        cells outside the grid.
+        """
+        array = self._layer_region(left, top, right, bottom)
+        Patch(self.origin[0], self.origin[1], self.grid).paint(array, left, top)
+        return array
+
+    def _layer_region(self, left, top, right, bottom):
+        """
+        Like region, but ignoring the grid.
+        """
+        array = np.zeros((bottom - top, right - left), np.uint8)
+        for layer in self.layers:
+            layer.paint(array, left, top)
+        return array
+
+    def cell(self, x, y):
+        """
+        Returns the state of the cell at
+        world position (x, y).
+        """
+        gx, gy = x - self.origin[0], y - self.origin[1]
+        height, width = self.grid.shape
+        if 0 <= gx < width and 0 <= gy < height:
+            return int(self.grid[gy, gx])
+        return int(self.region(x, y, x + 1, y + 1)[0, 0])
+
+    def _stats(self):
+        """
+        Returns (population, bounding box)
+        of the whole world.
+        """
+        population = int(np.count_nonzero(self.grid))
+        box = _nonzero_box(self.grid, *self.origin)
+
+        # Everything under the grid (or a patch)
+        # is hidden by it.
+        covered = [self._grid_rect()]
+        for i in range(len(self.layers) - 1, -1, -1):
+            layer = self.layers[i]
+            count, layer_box = layer.visible(
+                covered, [l for l in self.layers[i+1:]
+                          if isinstance(l, Highway)])
+            population += count
+            box = _union(box, layer_box)
+            if isinstance(layer, Patch):
+                covered.append(layer.rect)
+
+        return population, box
+
+    def population(self):
+        """
+        The number of cells not in state 0.
+        """
+        if not self.layers:
+            return int(np.count_nonzero(self.grid))
+        return self._stats()[0]
+
+    def bounding_box(self):
+        """
+        Returns the bounding box of the cells not
+        in state 0, as (left, top, right, bottom)
+        in world coordinates, with right and bottom
+        exclusive. Returns None if every cell is 0.
+        """
+        if not self.layers:
+            return _nonzero_box(self.grid, *self.origin)
+        return self._stats()[1]
+
+    def _grow(self, gx, gy):
+        """
+        Grow the grid so that grid position
+        (gx, gy), which is just off the edge,
+        lies inside it.
+        The grid grows by half its size along
+        the axis it grows on, so growing is
+        amortised constant time per cell.
+        """
+        height, width = self.grid.shape
+
+        dx = max(MIN_GROWTH, width // 2)
+        dy = max(MIN_GROWTH, height // 2)
+        left = dx if gx < 0 else 0
+        right = dx if gx >= width else 0
+        top = dy if gy < 0 else 0
+        bottom = dy if gy >= height else 0
+
+        origin = (self.origin[0] - left, self.origin[1] - top)
+        buf = np.full((height + top + bottom + 2, width + left + right + 2),
+                      SENTINEL, np.uint8)
+        buf[1:-1, 1:-1] = 0
+        # The new area may contain cells
+        # from layers under the grid.
+        for layer in self.layers:
+            layer.paint(buf[1:-1, 1:-1], *origin)
+        buf[top + 1:top + height + 1, left + 1:left + width + 1] = self.grid
+
+        self._buf = buf
+        self.origin = origin
+
+    def step(self, n=1):
+        """
+        Advance the simulation by n steps.
+        """
+        if not self.detect_highways:
+            self._step(n)
+            return
+
+        # Looking for a highway takes 2*MAX_PERIOD
+        # steps, so only bother if there's room
+        # to jump afterwards.
+        threshold = 4 * MAX_PERIOD
+        while n > 0:
+            if n >= threshold and self.steps >= self._next_check:
+                n -= self._try_highway(n)
+            else:
+                chunk = n
+                if n >= threshold:
+                    chunk = min(n, self._next_check - self.steps)
+                self._step(chunk)
+                n -= chunk
+
+    def _step(self, n, record=None):
+        """
+        Advance the simulation by n steps
+        without looking for highways.
+        If record is given, the state read on
+        each step is written to it.
+        """
+        offset = 0
+        while n > 0:
+            done = self._run(n, record, offset)
+            n -= done
+            offset += done
+            self.steps += done
+
+            gx, gy = self.x - self.origin[0], self.y - self.origin[1]
+            height, width = self.grid.shape
+            if not (0 <= gx < width and 0 <= gy < height):
+                self._grow(gx, gy)
+
+    def _run(self, n, record=None, offset=0):
+        """
+        Run up to n steps, stopping early if
+        the ant walks off the grid.
+        If record is given, the state read on
+        each step is written to it from offset.
+        Returns the number of steps run.
+        """
+        stride = self._buf.shape[1]
+        ox, oy = self.origin
+
+        # Flat index into the padded buffer
+        i = (self.y - oy + 1) * stride + (self.x - ox + 1)
+
+        turn, after = _tables(self._turns)
+        d = self.direction
+        done = 0
+        while done < n:
+            piece = min(n - done, TRACK_STEPS)
+            y0, x0 = divmod(i, stride)
+            ran, i, d = _walk(self._buf, i, d, piece, turn, after,
+                              record, offset + done)
+            done += ran
+
+            # The cell changed on step t of the piece
+            # is at most t steps from where it started
+            # and ran - t from where it ended, so it's
+            # within ran/2 of halfway between them.
+            y1, x1 = divmod(i, stride)
+            left = (x0 + x1 - ran + 1) // 2
+            top = (y0 + y1 - ran + 1) // 2
+            right = (x0 + x1 + ran) // 2 + 1
+            bottom = (y0 + y1 + ran) // 2 + 1
+            if ran:
+                self._touch((left - 1 + ox, top - 1 + oy,
+                             right - 1 + ox, bottom - 1 + oy))
+            if ran < piece:
+                # Stopped at the edge
+                break
+
+        y, x = divmod(i, stride)
+        self.x, self.y = x - 1 + ox, y - 1 + oy
+        self.direction = d
+
+        return done
+
+    def _touch(self, rect):
+        if self.touched is None:
+            self.touched = rect
+        else:
+            self.touched = _union(self.touched, rect)
+
+    def _try_highway(self, n):
+        """
+        Run some steps while recording them,
+        and if the ant is on a highway, jump
+        ahead by as many periods as possible
+        without exceeding n steps in total.
+        Returns the number of steps taken.
+        """
+        length = min(n, 2 * MAX_PERIOD)
+        if self.highway is not None and self._jumped_to is not None:
+            # End the recording a whole number of
+            # periods after the last jump, so that if
+            # the ant is still on that highway, the
+            # template matches and it can be extended.
+            period = self.highway[0]
+            length = min(n, length + (self._jumped_to - self.steps - length)
+                                     % period)
+        start = (self.x, self.y, self.direction, self.steps)
+        reads = bytearray(length)
+        self._step(length, reads)
+
+        jumped = self._jump(start, reads, n - length)
+        if jumped:
+            # Look again as soon as we can.
+            self._check_interval = CHECK_INTERVAL
+            self._next_check = self.steps
+        else:
+            self._next_check = self.steps + self._check_interval
+            self._check_interval = min(2 * self._check_interval,
+                                       MAX_CHECK_INTERVAL)
+        return length + jumped
+
+    def _find_period(self, reads, turns):
+        """
+        Returns the shortest period P such that
+        the last 2P recorded reads consist of the
+        same P reads twice over, and the ant faces
+        the same way after each period, or None.
+        """
+        view = memoryview(reads)
+        length = len(reads)
+        for period in range(1, length // 2 + 1):
+            if view[length-period:] == view[length-2*period:length-period] \
+               and int(turns[np.frombuffer(reads, np.uint8, period,
+                                           length-period)].sum()) % 4 == 0:
+                return period
+        return None
+
+    def _jump(self, start, reads, limit):
+        """
+        Given the state of the ant at the start
+        of a recorded run, as (x, y, direction,
+        steps), and the states read on each step,
+        check whether the last period of the run
+        will keep repeating, and if so skip ahead.
+        Never skips more than limit steps.
+        Returns the number of steps skipped.
+        """
+        turns = np.array(self._turns, np.int64)
+        period = self._find_period(reads, turns)
+        if period is None or limit // period < MIN_JUMP:
+            return 0
+
+        # Replay the recorded run to find where
+        # the ant was on each step of it.
+        record = np.frombuffer(reads, np.uint8)
+        dirs = (start[2] + np.cumsum(turns[record])) & 3
+        xs = start[0] + np.concatenate(([0], np.cumsum(np.take(DX, dirs))))
+        ys = start[1] + np.concatenate(([0], np.cumsum(np.take(DY, dirs))))
+
+        # The last period, [t, t + period)
+        t = len(reads) - period
+        px, py = xs[t:-1], ys[t:-1]
+        shift = (int(xs[-1] - xs[t]), int(ys[-1] - ys[t]))
+
+        # R: the box the ant moved around in
+        box = (int(px.min()), int(py.min()), int(px.max()) + 1,
+               int(py.max()) + 1)
+        left, top, right, bottom = box
+
+        # The box now, and as it was at t: the
+        # first state read from each cell visited
+        # during the period is what it held then.
+        now = self.region(*box)
+        before = now.copy()
+        first = np.unique((py - top) * (right - left) + (px - left),
+                          return_index=True)
+        before.reshape(-1)[first[0]] = record[t:][first[1]]
+
+        # The box ahead must now look like the
+        # box did at the start of the period...
+        sx, sy = shift
+        ahead = self.region(left + sx, top + sy, right + sx, bottom + sy)
+        if not np.array_equal(ahead, before):
+            return 0
+
+        if shift == (0, 0):
+            # The ant is going round in circles, and
+            # the whole world repeats every period.
+            periods = limit // period
+            self._note_highway(period, shift)
+            self.steps += periods * period
+            return periods * period
+
+        # ...and every cell the highway will sweep
+        # over, other than the box itself, must be
+        # empty.
+        periods = self._clear_ahead(box, shift, limit // period)
+        if periods < MIN_JUMP:
+            return 0
+        # (Before the grid changes)
+        self._note_highway(period, shift)
+
+        if not self._extend_highway(box, now, shift, periods):
+            # Freeze the world as it is, and
+            # lay the highway on top of it.
+            self.layers.append(Patch(self.origin[0], self.origin[1],
+                                     self.grid.copy()))
+            self.layers.append(Highway(left, top, now, shift, periods))
+
+        # Everything the highway swept over
+        self._touch(_union(box, (left + periods*sx, top + periods*sy,
+                                 right + periods*sx, bottom + periods*sy)))
+        self.x += periods * sx
+        self.y += periods * sy
+        self.steps += periods * period
+
+        # Start a fresh grid around the ant.
+        width = max(self._size[0], 4 * (right - left))
+        height = max(self._size[1], 4 * (bottom - top))
+        origin = (self.x - width // 2, self.y - height // 2)
+        # (The old grid is now the patch under the
+        # highway, so it mustn't be painted on top.)
+        cells = self._layer_region(origin[0], origin[1],
+                                   origin[0] + width, origin[1] + height)
+        self._buf = np.full((height + 2, width + 2), SENTINEL, np.uint8)
+        self._buf[1:-1, 1:-1] = cells
+        self.origin = origin
+
+        self._jumped_to = self.steps
+        return periods * period
+
+    def _extend_highway(self, box, template, shift, periods):
+        """
+        If the ant has carried on along the
+        highway on top of the layers since it
+        was laid, lengthen that highway to the
+        box, plus periods more, instead of adding
+        new layers. Otherwise a run stepped in
+        many small pieces would pile up layers.
+        Returns whether it did.
+        """
+        if not self.layers or not isinstance(self.layers[-1], Highway):
+            return False
+        last = self.layers[-1]
+        if last.shift != shift or not np.array_equal(last.template, template):
+            return False
+
+        # The box must be a whole number
+        # of periods further along.
+        sx, sy = shift
+        dx, dy = box[0] - last.box[0], box[1] - last.box[1]
+        m = dx // sx if sx else dy // sy
+        if m <= last.count or (m * sx, m * sy) != (dx, dy):
+            return False
+
+        # The grid must hold just what the longer
+        # highway would paint over the layers below.
+        longer = Highway(last.box[0], last.box[1], template, shift, m)
+        left, top, right, bottom = self._grid_rect()
+        expected = np.zeros((bottom - top, right - left), np.uint8)
+        for layer in self.layers[:-1] + [longer]:
+            layer.paint(expected, left, top)
+        if not np.array_equal(expected, self.grid):
+            return False
+
+        self.layers[-1] = Highway(last.box[0], last.box[1], template, shift,
+                                  m + periods)
+        return True
+
+    def _note_highway(self, period, shift):
+        """
+        Remember a highway the ant is on now.
+        """
+        if self.highway_onset is None:
+            self.highway_onset = self._find_onset(period)
+        self.highway = (period, shift)
+
+    def _find_onset(self, period):
+        """
+        Returns the first step from which the
+        states read have repeated every period,
+        up to now.
+        The ant can be run backwards (on a copy
+        of the grid), so this works back from
+        now to the first read which doesn't
+        match the one a period after it. The
+        grid must hold every cell visited so far,
+        i.e. there mustn't have been a jump yet.
+        """
+        buf = self._buf.copy()
+        stride = buf.shape[1]
+        offset_of = [-stride, 1, stride, -1]
+        cells = memoryview(buf.reshape(-1))
+        turns = self._turns
+        states = len(turns)
+
+        i = (self.y - self.origin[1] + 1) * stride + \
+            (self.x - self.origin[0] + 1)
+        d = self.direction
+        # The last period of reads, going
+        # backwards, by step modulo period
+        later = bytearray(period)
+        for k in range(self.steps):
+            # Undo a step: move back, and the cell
+            # there goes back to the state read.
+            i -= offset_of[d]
+            c = cells[i]
+            if c == SENTINEL:
+                break
+            c = c - 1 if c else states - 1
+            cells[i] = c
+            d = (d - turns[c]) & 3
+
+            slot = k % period
+            if k >= period and later[slot] != c:
+                return self.steps - k
+            later[slot] = c
+        else:
+            return 0
+        return self.steps - k
+
+    def _clear_ahead(self, box, shift, periods):
+        """
+        Returns how many of the given number of
+        periods (from 1) the box can be shifted
+        along by without meeting a non-zero cell
+        outside the box. At most MAX_SWEEP boxes
+        are checked cell by cell; past the edge of
+        the world they are known to be empty.
+        """
+        world = self._grid_rect()
+        for layer in self.layers:
+            world = _union(world, layer.rect)
+        grid_rect = self._grid_rect()
+
+        # Past this, the box is outside
+        # everything and must be empty.
+        last = _box_range(box, shift, world, 1, periods)[1]
+
+        sx, sy = shift
+        for m in range(1, min(last, periods) + 1):
+            if m > MAX_SWEEP:
+                return m - 1
+            moved = (box[0] + m*sx, box[1] + m*sy,
+                     box[2] + m*sx, box[3] + m*sy)
+            # The grid hides everything under it
+            if _intersect(moved, grid_rect) == moved:
+                ox, oy = self.origin
+                cells = self.grid[moved[1]-oy:moved[3]-oy,
+                                  moved[0]-ox:moved[2]-ox].copy()
+            else:
+                cells = self.region(*moved)
+
+            # Ignore the part still inside the box
+            overlap = _intersect(moved, box)
+            if overlap is not None:
+                cells[overlap[1]-moved[1]:overlap[3]-moved[1],
+                      overlap[0]-moved[0]:overlap[2]-moved[0]] = 0
+            if cells.any():
+                return m - 1
+        return periods
+
+
+class BatchSimulation:
+    """
+    Many independent ants, each with its own
+    rule and grid, advanced in lockstep with
+    NumPy operations across the whole batch.
+
+    The grids are stacked into one array of
+    shape (ants, height, width), which grows
+    for every ant whenever any ant nears an
+    edge. Positions are in world coordinates,
+    as for Simulation; origin is the world
+    position of grids[:, 0, 0].
+    """
+    # How close an ant may get to the edge
+    # before the grids grow.
+    MARGIN = MIN_GROWTH
+
+    def __init__(self, rules, size=(64, 64), pos=None, direction=UP,
+                 cells=None):
+        """
+        Initialises the batch.
+        rules is a list of rule strings, one
+        per ant. size is the initial (width,
+        height) of every grid. pos and direction
+        may be single values shared by every ant,
+        or one per ant; by default each ant starts
+        in the center facing up. cells, if given,
+        is an array of shape (ants, height, width)
+        holding the starting grids.
+        """
+        self.rules = [rule.upper() for rule in rules]
+        count = len(rules)
+        width, height = size
+
+        # Per-ant lookup tables, indexed by
+        # ant * 256 + state.
+        self._turn = np.zeros((count, 256), np.int64)
+        self._after = np.zeros((count, 256), np.uint8)
+        for k, rule in enumerate(rules):
+            turns = parse_rule(rule)
+            self._turn[k, :len(turns)] = turns
+            self._after[k, :len(turns)] = list(range(1, len(turns))) + [0]
+        self._turn = self._turn.reshape(-1)
+        self._after = self._after.reshape(-1)
+
+        if cells is None:
+            self._grids = np.zeros((count, height, width), np.uint8)
+        else:
+            self._grids = np.array(cells, np.uint8).reshape(count, height, width)
+        self.origin = (0, 0)
+
+        if pos is None:
+            pos = (width // 2, height // 2)
+        pos = np.broadcast_to(np.asarray(pos, np.int64), (count, 2))
+        self.x = pos[:, 0].copy()
+        self.y = pos[:, 1].copy()
+        self.direction = np.broadcast_to(np.asarray(direction, np.int64),
+                                         (count,)).copy()
+
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.rules)
+
+    @property
+    def grids(self):
+        """
+        The stack of grids, indexed [ant, y, x].
+        Replaced whenever the grids grow.
+        """
+        return self._grids
+
+    def population(self):
+        """
+        An array of the number of cells
+        not in state 0, per ant.
+        """
+        return np.count_nonzero(self._grids.reshape(len(self), -1), axis=1)
+
+    def bounding_boxes(self):
+        """
+        A list of the bounding boxes of the
+        cells not in state 0 in each grid, as
+        for Simulation.bounding_box.
+        """
+        return [_nonzero_box(grid, *self.origin) for grid in self._grids]
+
+    def _margin(self):
+        """
+        The smallest distance from any
+        ant to the edge of its grid.
+        """
+        height, width = self._grids.shape[1:]
+        gx = self.x - self.origin[0]
+        gy = self.y - self.origin[1]
+        return int(min(gx.min(), gy.min(),
+                       width - 1 - gx.max(), height - 1 - gy.max()))
+
+    def _grow(self):
+        """
+        Grow every grid on each side that
+        some ant is close to.
+        """
+        count, height, width = self._grids.shape
+        gx = self.x - self.origin[0]
+        gy = self.y - self.origin[1]
+
+        dx = max(MIN_GROWTH, width // 2)
+        dy = max(MIN_GROWTH, height // 2)
+        left = dx if gx.min() < self.MARGIN else 0
+        right = dx if width - 1 - gx.max() < self.MARGIN else 0
+        top = dy if gy.min() < self.MARGIN else 0
+        bottom = dy if height - 1 - gy.max() < self.MARGIN else 0
+
+        grids = np.zeros((count, height + top + bottom, width + left + right),
+                         np.uint8)
+        grids[:, top:top + height, left:left + width] = self._grids
+
+        self._grids = grids
+        self.origin = (self.origin[0] - left, self.origin[1] - top)
+
+    def step(self, n=1):
+        """
+        Advance every ant by n steps.
+        """
+        while n > 0:
+            margin = self._margin()
+            if margin < self.MARGIN:
+                self._grow()
+                continue
+
+            # No ant can reach the edge within
+            # margin steps, so there's no need
+            # to check bounds inside the loop.
+            chunk = min(n, margin)
+            self._run(chunk)
+            n -= chunk
+            self.steps += chunk
+
+    def _run(self, n):
+        """
+        Run n steps, which must not take
+        any ant off its grid.
+        """
+        count, height, width = self._grids.shape
+        ox, oy = self.origin
+
+        cells = self._grids.reshape(-1)
+        turn_table = self._turn
+        after_table = self._after
+        offsets = np.array([-width, 1, width, -1], np.int64)
+
+        # Flat index of each ant's cell, and
+        # the start of its row in the tables
+        i = (np.arange(count, dtype=np.int64) * (height * width) +
+             (self.y - oy) * width + (self.x - ox))
+        base = np.arange(count, dtype=np.int64) * 256
+        d = self.direction.copy()
+
+        # Scratch arrays, so the loop
+        # doesn't allocate anything.
+        c = np.empty(count, np.uint8)
+        t = np.empty(count, np.int64)
+        turn = np.empty(count, np.int64)
+        after = np.empty(count, np.uint8)
+        move = np.empty(count, np.int64)
+
+        # Every index is known to be in range, and
+        # mode='clip' skips numpy's bounds checks
+        # (and the copies they cause), which makes
+        # the loop several times faster.
+        # (Plain index assignment beats np.put.)
+        take, add = np.take, np.add
+        for s in range(n):
+            take(cells, i, out=c, mode='clip')
+            add(base, c, out=t)
+            take(turn_table, t, out=turn, mode='clip')
+            add(d, turn, out=d)
+            d &= 3
+            take(after_table, t, out=after, mode='clip')
+            cells[i] = after
+            take(offsets, d, out=move, mode='clip')
+            i += move
+
+        # Back to world coordinates
+        i -= np.arange(count, dtype=np.int64) * (height * width)
+        gy, gx = np.divmod(i, width)
+        self.x = gx + ox
+        self.y = gy + oy
+        self.direction = d
+
+
+class ChunkStore:
+    """
+    A memory-mapped file of fixed-size chunks,
+    where a ChunkedGrid keeps the chunks it
+    has evicted from memory.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, path=None):
+        """
+        Initialises the store. With no path,
+        an anonymous temporary file is used,
+        which vanishes when the store is closed.
+        """
+        self.chunk_size = chunk_size
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(path, 'w+b')
+
+        # key -> slot in the file
+        self._slots = {}
+        self._free = []
+        self._array = None
+        self._capacity = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def keys(self):
+        return self._slots.keys()
+
+    def _reserve(self, capacity):
+        """
+        Grow the file to hold at least
+        capacity chunks.
+        """
+        capacity = max(capacity, 2 * self._capacity, 16)
+        size = self.chunk_size
+        # Drop the old mapping before
+        # the file changes size.
+        self._array = None
+        self._file.truncate(capacity * size * size)
+        self._array = np.memmap(self._file, np.uint8, 'r+',
+                                shape=(capacity, size, size))
+        self._free.extend(range(capacity - 1, self._capacity - 1, -1))
+        self._capacity = capacity
+
+    def put(self, key, cells):
+        """
+        Store a chunk of cells under key,
+        replacing any already there.
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            if not self._free:
+                self._reserve(self._capacity + 1)
+            slot = self._free.pop()
+            self._slots[key] = slot
+        self._array[slot] = cells
+
+    def get(self, key):
+        """
+        Returns a view of the chunk stored under
+        key, or None. The view is only valid
+        until the next put.
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        return self._array[slot]
+
+    def discard(self, key):
+        """
+        Forget the chunk stored under key.
+        """
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def close(self):
+        self._array = None
+        self._file.close()
+
+
+class ChunkedGrid:
+    """
+    An unbounded grid of cell states, stored
+    as square NumPy chunks in a dict, keyed by
+    chunk coordinates. Only chunks which have
+    been written to exist; every other cell
+    is 0.
+
+    Up to max_chunks chunks are kept in memory.
+    Beyond that, the least recently used ones
+    are spilled to a ChunkStore on disk, and
+    read back when they are next needed.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS,
+                 path=None):
+        """
+        Initialises the grid. path is where
+        spilled chunks are stored; by default
+        a temporary file.
+        """
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self._path = path
+
+        # (cx, cy) -> chunk with a sentinel border,
+        # in order of use, most recent last.
+        self._chunks = OrderedDict()
+        self._store = None
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        """
+        The set of keys of every chunk,
+        in memory or on disk.
+        """
+        keys = set(self._chunks)
+        if self._store is not None:
+            keys.update(self._store.keys())
+        return keys
+
+    def chunk(self, cx, cy):
+        """
+        Returns the chunk at (cx, cy), with a
+        one cell sentinel border, creating it
+        or reading it back from disk if needed.
+        The chunk stays valid until max_chunks
+        other chunks have been used.
+        """
+        key = (cx, cy)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+
+        size = self.chunk_size
+        chunk = np.full((size + 2, size + 2), SENTINEL, np.uint8)
+        stored = self._store.get(key) if self._store is not None else None
+        if stored is not None:
+            chunk[1:-1, 1:-1] = stored
+        else:
+            chunk[1:-1, 1:-1] = 0
+        self._chunks[key] = chunk
+
+        while len(self._chunks) > self.max_chunks:
+            self._evict()
+        return chunk
+
+    def _evict(self):
+        """
+        Spill the least recently used
+        chunk to disk.
+        """
+        key, chunk = self._chunks.popitem(last=False)
+        cells = chunk[1:-1, 1:-1]
+        if not cells.any():
+            # Nothing worth keeping
+            if self._store is not None:
+                self._store.discard(key)
+            return
+        if self._store is None:
+            self._store = ChunkStore(self.chunk_size, self._path)
+        self._store.put(key, cells)
+
+    def _peek(self, key):
+        """
+        Returns the cells of a chunk without
+        loading it into memory, or None.
+        """
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            return chunk[1:-1, 1:-1]
+        if self._store is not None:
+            return self._store.get(key)
+        return None
+
+    def cell(self, x, y):
+        """
+        Returns the state of the cell at (x, y).
+        """
+        size = self.chunk_size
+        cells = self._peek((x // size, y // size))
+        if cells is None:
+            return 0
+        return int(cells[y % size, x % size])
+
+    def region(self, left, top, right, bottom):
+        """
+        Returns a new array of the cell states
+        in the given rect (right and bottom
+        exclusive).
+        """
+        array = np.zeros((bottom - top, right - left), np.uint8)
+        size = self.chunk_size
+        for cx in range(left // size, (right - 1) // size + 1):
+            for cy in range(top // size, (bottom - 1) // size + 1):
+                cells = self._peek((cx, cy))
+                if cells is not None:
+                    Patch(cx * size, cy * size, cells).paint(array, left, top)
+        return array
+
+    def population(self):
+        """
+        The number of cells not in state 0.
+        """
+        return sum(int(np.count_nonzero(self._peek(key)))
+                   for key in self.keys())
+
+    def bounding_box(self):
+        """
+        Returns the bounding box of the cells not
+        in state 0, as (left, top, right, bottom),
+        with right and bottom exclusive, or None.
+        """
+        size = self.chunk_size
+        box = None
+        for cx, cy in self.keys():
+            box = _union(box, _nonzero_box(self._peek((cx, cy)),
+                                           cx * size, cy * size))
+        return box
+
+    def close(self):
+        """
+        Release the file of spilled chunks.
+        """
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+class SparseSimulation:
+    """
+    A single ant on a ChunkedGrid, so memory is
+    only used for the chunks the ant has visited,
+    and only the recently visited ones stay in
+    memory. The grid never needs reallocating.
+
+    Unlike Simulation, highways aren't skipped;
+    use this for the runs whose pattern is too
+    large or irregular for a dense grid.
+    """
+    def __init__(self, rule='RL', pos=(0, 0), direction=UP,
+                 chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS, path=None):
+        """
+        Initialises the simulation.
+        pos is the ant's starting position.
+        chunk_size, max_chunks and path
+        are passed to ChunkedGrid.
+        """
+        self.rule = rule.upper()
+        self._turns = parse_rule(rule)
+        self._tables = _tables(self._turns)
+
+        self.chunks = ChunkedGrid(chunk_size, max_chunks, path)
+        self.x, self.y = pos
+        self.direction = direction
+
+        self.steps = 0
+
+    @property
+    def states(self):
+        """
+        The number of cell states.
+        """
+        return len(self._turns)
+
+    def cell(self, x, y):
+        return self.chunks.cell(x, y)
+
+    def region(self, left, top, right, bottom):
+        return self.chunks.region(left, top, right, bottom)
+
+    def population(self):
+        return self.chunks.population()
+
+    def bounding_box(self):
+        return self.chunks.bounding_box()
+
+    def step(self, n=1):
+        """
+        Advance the simulation by n steps.
+        """
+        size = self.chunks.chunk_size
+        stride = size + 2
+        turn, after = self._tables
+        d = self.direction
+
+        while n > 0:
+            cx, cy = self.x // size, self.y // size
+            chunk = self.chunks.chunk(cx, cy)
+
+            # Run until the ant leaves the chunk
+            i = (self.y - cy * size + 1) * stride + (self.x - cx * size + 1)
+            done, i, d = _walk(chunk, i, d, n, turn, after)
+            n -= done
+            self.steps += done
+
+            y, x = divmod(i, stride)
+            self.x, self.y = x - 1 + cx * size, y - 1 + cy * size
+
+        self.direction = d
+
+    def close(self):
+        self.chunks.close()
@@ -0,0 +1,150 @@
+"""
+Runs Langton's Ant simulations for many rules
+across all CPU cores, without opening a window.
+
+Each finished run is written straight away as
+one line of JSON, so a killed sweep keeps every
+result it had finished, and --resume skips them
+next time. For example:
+    python sweep.py RL RLR LLRR --steps 20000 1000000
+    python sweep.py --enumerate 4 --steps 100000 -o out.jsonl
+"""
+import sys, json, time, argparse, itertools
+import multiprocessing
+
+# Deliberately doesn't import pygame or ui.
+import simulation
+
+
+def run(job):
+    """
+    Run one simulation, given a
+    (rule, steps, detect_highways) tuple.
+    Returns a dict of results.
+    """
+    rule, steps, detect_highways = job
+
+    start = time.perf_counter()
+    sim = simulation.Simulation(rule, detect_highways=detect_highways)
+    sim.step(steps)
+    box = sim.bounding_box()
+    population = sim.population()
+    wall_time = time.perf_counter() - start
+
+    result = {
+        'rule': sim.rule,
+        'steps': steps,
+        'population': population,
+        'bounding_box': list(box) if box is not None else None,
+        'ant': [sim.x, sim.y, sim.direction],
+        'highway_onset': sim.highway_onset,
+        'wall_time': wall_time,
+    }
+    if sim.highway is not None:
+        period, shift = sim.highway
+        result['highway_period'] = period
+        result['highway_shift'] = list(shift)
+    return result
+
+
+def enumerate_rules(length):
+    """
+    Every rule of R and L turns of the given
+    length, skipping ones which are the same
+    as an earlier rule with R and L swapped
+    (which just mirror it).
+    """
+    for turns in itertools.product('RL', repeat=length):
+        if turns[0] == 'R':
+            yield ''.join(turns)
+
+
+def load_done(path):
+    """
+    The (rule, steps) pairs already
+    in an output file.
+    """
+    done = set()
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return done
+    with f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short by a kill
+                continue
+            done.add((result['rule'], result['steps']))
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('rules', nargs='*', help='rule strings, e.g. RL')
+    parser.add_argument('--rules-file',
+                        help='file with one rule per line')
+    parser.add_argument('--enumerate', type=int, metavar='LENGTH',
+                        help='also run every R/L rule of this length')
+    parser.add_argument('--steps', type=int, nargs='+', default=[100000],
+                        help='step counts to run each rule for; highways '
+                             'are only looked for in runs of at least %d '
+                             '(default: 100000)' % (4 * simulation.MAX_PERIOD))
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of processes (default: all cores)')
+    parser.add_argument('--no-highways', action='store_true',
+                        help="don't detect and skip highways")
+    parser.add_argument('-o', '--output',
+                        help='append results to this file '
+                             '(default: stdout)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip runs already in the output file')
+    args = parser.parse_args(argv)
+
+    rules = list(args.rules)
+    if args.rules_file:
+        with open(args.rules_file) as f:
+            rules.extend(line.strip() for line in f if line.strip())
+    if args.enumerate:
+        rules.extend(enumerate_rules(args.enumerate))
+    if not rules:
+        parser.error('no rules given')
+
+    # Check rules up front, rather than
+    # failing inside a worker.
+    for rule in rules:
+        try:
+            simulation.parse_rule(rule)
+        except ValueError as e:
+            parser.error(str(e))
+
+    done = set()
+    if args.resume:
+        if not args.output:
+            parser.error('--resume needs --output')
+        done = load_done(args.output)
+
+    jobs = [(rule.upper(), steps, not args.no_highways)
+            for rule in rules for steps in args.steps
+            if (rule.upper(), steps) not in done]
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        with multiprocessing.Pool(args.workers) as pool:
+            # Small chunks, so results arrive (and
+            # are saved) as soon as they're ready.
+            for result in pool.imap_unordered(run, jobs, chunksize=1):
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Tests for checkpoints. Run with:
+    python -m pytest
+"""
+import os
+
+import pytest
+
+import checkpoint
+import simulation
+
+
+class Crash(Exception):
+    pass
+
+
+def _state(sim):
+    return (sim.x, sim.y, sim.direction, sim.steps, sim.grid.copy())
+
+
+def _assert_state(sim, state):
+    x, y, direction, steps, grid = state
+    assert (sim.x, sim.y, sim.direction, sim.steps) == (x, y, direction,
+                                                         steps)
+    assert (sim.grid == grid).all()
+
+
+def _crash_saving(monkeypatch, tmp_path):
+    """
+    Save a run, step it, then crash part way
+    through saving it again: after the journal
+    is written, before the checkpoint is.
+    Returns (path, state saved, state being saved).
+    """
+    path = str(tmp_path / 'run.ckpt')
+    sim = simulation.Simulation('LLRR', size=(200, 200))
+    sim.step(5000)
+    saver = checkpoint.Checkpointer(path)
+    saver.save(sim)
+    saved = _state(sim)
+
+    sim.step(500)
+
+    def crash(path, records):
+        raise Crash()
+    monkeypatch.setattr(checkpoint, '_apply', crash)
+    with pytest.raises(Crash):
+        saver.save(sim)
+    monkeypatch.undo()
+    assert os.path.exists(path + '.journal')
+    return path, saved, _state(sim)
+
+
+def test_incomplete_journal_is_discarded(monkeypatch, tmp_path):
+    path, saved, saving = _crash_saving(monkeypatch, tmp_path)
+    # The crash came while the journal was
+    # still being written.
+    journal = path + '.journal'
+    with open(journal, 'r+b') as f:
+        f.truncate(os.path.getsize(journal) // 2)
+
+    _assert_state(checkpoint.load(path), saved)
+    assert not os.path.exists(journal)
+
+
+def test_complete_journal_is_replayed(monkeypatch, tmp_path):
+    path, saved, saving = _crash_saving(monkeypatch, tmp_path)
+
+    _assert_state(checkpoint.load(path), saving)
+    assert not os.path.exists(path + '.journal')
@@ -0,0 +1,63 @@
+"""
+Tests for the simulation engine. Run with:
+    python -m pytest
+"""
+import pytest
+
+import simulation
+
+
+# (rule, step the highway starts on, period),
+# checked against a plain run's reads.
+ONSETS = [
+    ('RL', 9977, 104),
+    ('RRL', 39, 18),
+]
+
+
+@pytest.mark.parametrize('rule, onset, period', ONSETS)
+@pytest.mark.parametrize('chunk', [None, 20000, 50000])
+def test_highway_onset(rule, onset, period, chunk):
+    sim = simulation.Simulation(rule, detect_highways=True)
+    if chunk is None:
+        sim.step(200000)
+    else:
+        for i in range(200000 // chunk):
+            sim.step(chunk)
+    assert sim.highway_onset == onset
+    assert sim.highway[0] == period
+
+
+def _run(rule, steps, chunk, detect_highways):
+    sim = simulation.Simulation(rule, detect_highways=detect_highways)
+    if chunk is None:
+        sim.step(steps)
+    else:
+        for i in range(steps // chunk):
+            sim.step(chunk)
+        sim.step(steps % chunk)
+    return sim
+
+
+# Rules which build a highway within the
+# steps run, and some which don't (so any
+# jump would be a mistake).
+HIGHWAY_RULES = ['RL', 'LR', 'RRL']
+OTHER_RULES = ['RLR', 'LLRR', 'RLLR', 'LRRRRRLLR']
+
+
+@pytest.mark.parametrize('rule', HIGHWAY_RULES + OTHER_RULES)
+@pytest.mark.parametrize('chunk', [None, 20000, 33333])
+def test_highway_jump_is_exact(rule, chunk):
+    steps = 120000
+    plain = _run(rule, steps, None, False)
+    fast = _run(rule, steps, chunk, True)
+    # Whether it jumped at all
+    assert bool(fast.layers) == (rule in HIGHWAY_RULES)
+
+    assert (fast.x, fast.y, fast.direction, fast.steps) == \
+        (plain.x, plain.y, plain.direction, plain.steps)
+    assert fast.population() == plain.population()
+    box = plain.bounding_box()
+    assert fast.bounding_box() == box
+    assert (fast.region(*box) == plain.region(*box)).all()
@@ -0,0 +1,125 @@
+"""
+Tests for the ui module. Run with:
+    python -m pytest
+"""
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+import pytest
+
+# ui loads its icons, relative to the working
+# directory, and converts surfaces, which needs
+# a display, as soon as it's imported.
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+pygame.init()
+pygame.display.set_mode((400, 400))
+
+import ui
+
+
+WHITE = (255, 255, 255)
+
+
+def _full_redraw(root, size):
+    surface = pygame.Surface(size)
+    surface.fill(WHITE)
+    root.draw(surface)
+    return surface
+
+
+def _assert_same(a, b):
+    assert (pygame.surfarray.array3d(a) ==
+            pygame.surfarray.array3d(b)).all()
+
+
+def _scene():
+    root = ui.UnboundedContainer()
+    for i in range(6):
+        root.children.append(ui.Checkbox((10 + i * 60, 10)))
+    group = ui.UnboundedContainer()
+    for i in range(3):
+        group.children.append(ui.Checkbox((10 + i * 60, 200)))
+    root.children.append(group)
+
+    screen = pygame.Surface((400, 400))
+    screen.fill(WHITE)
+    root.update()
+    root.draw_dirty(screen, WHITE)
+    return root, group, screen
+
+
+REMOVALS = [
+    lambda root, group: root.children.remove(root.children[2]),
+    lambda root, group: root.children.pop(0),
+    lambda root, group: root.children.__delitem__(slice(1, 3)),
+    lambda root, group: setattr(root, 'children', root.children[3:]),
+    lambda root, group: root.children.clear(),
+    lambda root, group: group.children.pop(),
+    lambda root, group: root.children.remove(group),
+]
+
+
+@pytest.mark.parametrize('remove', REMOVALS,
+                         ids=['remove', 'pop', 'del', 'assign', 'clear',
+                              'from_group', 'group'])
+def test_removed_child_is_cleared(remove):
+    root, group, screen = _scene()
+
+    remove(root, group)
+    root.update()
+    assert root.draw_dirty(screen, WHITE)
+    _assert_same(screen, _full_redraw(root, (400, 400)))
+
+
+def test_removed_child_is_drawn_when_added_back():
+    root, group, screen = _scene()
+
+    child = root.children.pop(1)
+    root.update()
+    root.draw_dirty(screen, WHITE)
+    group.children.append(child)
+    root.update()
+    root.draw_dirty(screen, WHITE)
+    _assert_same(screen, _full_redraw(root, (400, 400)))
+
+
+def test_group_removed_after_its_child_is_cleared():
+    root, group, screen = _scene()
+
+    group.children.pop(0)
+    root.children.remove(group)
+    root.update()
+    root.draw_dirty(screen, WHITE)
+    _assert_same(screen, _full_redraw(root, (400, 400)))
+
+
+def test_autosize_after_moving_a_child_by_hand():
+    container = ui.Container((0, 0))
+    for i in range(3):
+        container.children.append(ui.Checkbox((i * 10, 0)))
+    container.autosize()
+    assert container.size == (75, 55)
+
+    container.children[0].pos = (100, 100)
+    container.autosize()
+    assert container.size == (155, 155)
+
+    # Back in, so the edges are defined by
+    # the other children again.
+    container.children[0].pos = (0, 0)
+    container.autosize()
+    assert container.size == (75, 55)
+
+
+def test_autosize_recurses_into_containers():
+    outer = ui.Container((0, 0))
+    inner = ui.Container((10, 10))
+    inner.children.append(ui.Checkbox((0, 0)))
+    outer.children.append(inner)
+    outer.children.append(ui.Checkbox((0, 0)))
+    outer.autosize(recurse=True)
+    assert inner.size == (55, 55)
+    assert outer.size == (70, 70)
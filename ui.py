@@ -1,4 +1,6 @@
-import pygame, math
+import pygame, math, time, json, functools, weakref, bisect, contextlib, abc
+import numpy as np
+from collections import OrderedDict, deque
 
 def get_fps():
     return 60.0 # Temporary; changed by main
@@ -26,22 +28,822 @@ def colour_mix(a, b, amount):
        len(b) < 2 or len(b) > 4:
         raise ValueError("Incorrect number of channels in colour")
     
+    # Don't modify the caller's colours
     if len(a) == 3:
-        a += [255]
+        a = list(a) + [255]
     if len(b) == 3:
-        b += [255]
+        b = list(b) + [255]
     
     return [(x + (y-x)*amount) for x,y in zip(a,b)]
 
+class SurfaceCache:
+    """
+    A least-recently-used cache of
+    surfaces, which evicts old entries
+    once the total size of the cached
+    surfaces exceeds a limit.
+    """
+    def __init__(self, max_bytes):
+        """
+        Initialises the cache.
+        max_bytes is the memory cap,
+        in bytes of pixel data.
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self._entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    @staticmethod
+    def _sizeof(surface):
+        return surface.get_width() * surface.get_height() * \
+               surface.get_bytesize()
+    
+    def get(self, key):
+        """
+        Returns the surface stored
+        under key, or None.
+        """
+        surface = self._entries.get(key)
+        if surface is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return surface
+    
+    def put(self, key, surface):
+        """
+        Stores a surface under key,
+        evicting the least recently
+        used surfaces if needed.
+        Surfaces larger than the whole
+        cache are not stored.
+        """
+        size = self._sizeof(surface)
+        if size > self.max_bytes:
+            return
+        
+        if key in self._entries:
+            self.bytes -= self._sizeof(self._entries.pop(key))
+        
+        self._entries[key] = surface
+        self.bytes += size
+        
+        while self.bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self.bytes -= self._sizeof(old)
+    
+    def discard(self, key):
+        """
+        Removes the surface stored
+        under key, if there is one.
+        """
+        surface = self._entries.pop(key, None)
+        if surface is not None:
+            self.bytes -= self._sizeof(surface)
+    
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        self._entries.clear()
+        self.bytes = 0
+
+
+# Ink ripple sprites, shared by
+# every widget which draws ink.
+ink_cache = SurfaceCache(8 * 1024 * 1024)
+# The number of distinct frames
+# in an ink ripple.
+INK_STEPS = 32
+
+def ink_sprite(radius, progress):
+    """
+    Returns a surface of size 2*radius
+    holding a white ink ripple, centered
+    on the surface, progress of the way
+    (0.0 to 1.0) through its animation.
+    It's white so that one sprite serves
+    every colour: tint it by multiplying
+    (see draw_ink).
+    The surface is shared, so it must
+    not be drawn on.
+    """
+    step = int(round(progress * INK_STEPS))
+    
+    key = (radius, step)
+    
+    sprite = ink_cache.get(key)
+    if sprite is None:
+        progress = step / INK_STEPS
+        
+        sprite = pygame.Surface([int(radius*2)]*2, pygame.SRCALPHA, 32)
+        sprite = sprite.convert_alpha()
+        sprite.fill((255,255,255,0))
+        
+        pygame.draw.circle(sprite, (255, 255, 255,
+                                    255 - int(255 * progress)),
+                           [int(radius)]*2,
+                           int(radius/2+
+                               (radius/2)*
+                               # Deceleration curve
+                               math.sqrt(progress)
+                               )
+                           )
+        
+        ink_cache.put(key, sprite)
+    return sprite
+
+def draw_ink(surface, pos, radius, colour, progress):
+    """
+    Draws an ink ripple (see ink_sprite)
+    of the given colour onto surface, with
+    its top left corner at pos.
+    """
+    sprite = ink_sprite(radius, progress)
+    tinted = surface_pool.acquire(sprite.get_size())
+    tinted.fill(colour[:3])
+    tinted.blit(sprite, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
+    surface.blit(tinted, pos)
+    surface_pool.release(tinted)
+
+# Fonts shared by every widget,
+# keyed by (name, size).
+_fonts = {}
+
+def get_font(name=None, size=36):
+    """
+    Returns a pygame Font for the given
+    font file name (None for the default
+    font) and size, loading it only the
+    first time it is asked for.
+    """
+    key = (name, size)
+    font = _fonts.get(key)
+    if font is None:
+        font = pygame.font.Font(name, size)
+        _fonts[key] = font
+    return font
+
+# Rendered text, shared by every widget
+# which draws text.
+text_cache = SurfaceCache(4 * 1024 * 1024)
+
+def render_text(font, text, colour, antialias=True):
+    """
+    Returns a surface holding text rendered
+    in the given font and colour, only
+    rendering it if it isn't cached.
+    The surface is shared, so it must
+    not be drawn on.
+    """
+    key = (font, text, tuple(colour), antialias)
+    
+    rendered = text_cache.get(key)
+    if rendered is None:
+        rendered = font.render(text, antialias, colour)
+        text_cache.put(key, rendered)
+    return rendered
+
+class SurfacePool:
+    """
+    A pool of scratch surfaces, shared by
+    every widget, so that widgets only hold
+    a scratch surface while drawing instead
+    of keeping their own.
+    Surfaces are bucketed by size, rounded
+    up to powers of two.
+    """
+    def __init__(self, max_per_bucket=4):
+        """
+        Initialises the pool.
+        max_per_bucket is the most spare
+        surfaces kept of each size.
+        """
+        self.max_per_bucket = max_per_bucket
+        
+        # (width, height) -> list of surfaces
+        self._free = {}
+    
+    @staticmethod
+    def _bucket(size):
+        return tuple(max(16, 1 << (int(n) - 1).bit_length()) for n in size)
+    
+    def acquire(self, size):
+        """
+        Returns a transparent-capable surface
+        of the given size, with undefined
+        contents. Give it back with release
+        once finished with.
+        """
+        bucket = self._bucket(size)
+        free = self._free.get(bucket)
+        if free:
+            surface = free.pop()
+        else:
+            surface = pygame.Surface(bucket, pygame.SRCALPHA, 32)
+            surface = surface.convert_alpha()
+        return surface.subsurface((0, 0) + tuple(size))
+    
+    def release(self, surface):
+        """
+        Return a surface from acquire
+        to the pool.
+        """
+        surface = surface.get_parent()
+        free = self._free.setdefault(surface.get_size(), [])
+        if len(free) < self.max_per_bucket:
+            free.append(surface)
+    
+    def clear(self):
+        """
+        Drop every spare surface.
+        """
+        self._free.clear()
+
+surface_pool = SurfacePool()
+
+class Animator:
+    """
+    Every animated value, stored as NumPy
+    arrays of values, targets and speeds, and
+    advanced all at once, once per frame.
+    Values move linearly towards their targets.
+    
+    Widgets hold a slot each and read their
+    value from shown[slot], so the cost of
+    animating doesn't grow with the number of
+    Python objects. Call advance once a frame,
+    or on a fixed timestep (see Scheduler) and
+    then interpolate before drawing.
+    """
+    def __init__(self, capacity=64):
+        """
+        Initialises the animator with room
+        for capacity values (it grows as
+        needed).
+        """
+        self.values = np.zeros(capacity)
+        # The values as of the step before,
+        # and the values to draw: somewhere
+        # in between the two.
+        self.previous = np.zeros(capacity)
+        self.shown = np.zeros(capacity)
+        self.targets = np.zeros(capacity)
+        # Units per second
+        self.speeds = np.zeros(capacity)
+        
+        self._free = list(range(capacity - 1, -1, -1))
+        # Scratch arrays, so advance
+        # doesn't allocate anything.
+        self._step = np.zeros(capacity)
+        self._distance = np.zeros(capacity)
+        self._scratch = np.zeros(capacity)
+        self._arrived = np.zeros(capacity, bool)
+    
+    def __len__(self):
+        return len(self.values) - len(self._free)
+    
+    def _grow(self):
+        old = len(self.values)
+        new = old * 2
+        for name in ('values', 'previous', 'shown', 'targets', 'speeds',
+                     '_step', '_distance', '_scratch'):
+            array = np.zeros(new)
+            array[:old] = getattr(self, name)
+            setattr(self, name, array)
+        self._arrived = np.zeros(new, bool)
+        self._free.extend(range(new - 1, old - 1, -1))
+    
+    def add(self, value=0.0):
+        """
+        Returns a new slot, holding value.
+        """
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self.values[slot] = self.targets[slot] = value
+        self.previous[slot] = self.shown[slot] = value
+        self.speeds[slot] = 0.0
+        return slot
+    
+    def remove(self, slot):
+        """
+        Give a slot back.
+        """
+        self.values[slot] = self.targets[slot] = self.speeds[slot] = 0.0
+        self.previous[slot] = self.shown[slot] = 0.0
+        self._free.append(slot)
+    
+    def animate(self, slot, target, duration):
+        """
+        Start moving a slot's value towards
+        target, by 1.0 every duration seconds.
+        """
+        self.targets[slot] = target
+        self.speeds[slot] = 1.0 / duration if duration > 0 else np.inf
+    
+    def is_animating(self, slot):
+        return self.values[slot] != self.targets[slot] or \
+               self.shown[slot] != self.values[slot]
+    
+    def advance(self, dt=None):
+        """
+        Move every value towards its target by
+        dt seconds' worth, by default one frame.
+        """
+        if dt is None:
+            dt = 1.0 / get_fps()
+        
+        self.previous[...] = self.values
+        
+        step, arrived = self._step, self._arrived
+        distance, scratch = self._distance, self._scratch
+        np.multiply(self.speeds, dt, out=step)
+        
+        # Values within one step of their
+        # target land on it exactly.
+        np.subtract(self.targets, self.values, out=distance)
+        np.abs(distance, out=scratch)
+        np.less_equal(scratch, step, out=arrived)
+        # Otherwise they move one step.
+        np.minimum(distance, step, out=distance)
+        np.negative(step, out=scratch)
+        np.maximum(distance, scratch, out=distance)
+        self.values += distance
+        np.copyto(self.values, self.targets, where=arrived)
+        
+        self.shown[...] = self.values
+    
+    def interpolate(self, alpha):
+        """
+        Set the values to draw to alpha (0.0
+        to 1.0) of the way from the previous
+        step's values to the current ones.
+        """
+        np.subtract(self.values, self.previous, out=self.shown)
+        self.shown *= alpha
+        self.shown += self.previous
+
+animator = Animator()
+
+class Scheduler:
+    """
+    Runs updates on a fixed timestep of real
+    time, independent of the frame rate.
+    
+    Each frame, run() calls the step tasks once
+    for every timestep that has passed (with
+    the timestep as the argument), catching up
+    if frames are slow. The fraction of a step
+    left over is returned, for interpolating
+    what's drawn. Then the spare tasks are
+    called over and over, until the frame's
+    time budget is used up, for open-ended work
+    such as stepping a simulation.
+    """
+    def __init__(self, timestep=1/120, max_steps=8):
+        """
+        Initialises the scheduler.
+        timestep is in seconds. max_steps is
+        the most steps run in one frame; past
+        that, time is dropped rather than
+        falling further and further behind.
+        """
+        self.timestep = timestep
+        self.max_steps = max_steps
+        
+        self.step_tasks = []
+        self.spare_tasks = []
+        
+        # The interpolation fraction
+        # from the last run.
+        self.alpha = 0.0
+        
+        self._accumulated = 0.0
+        self._last = time.perf_counter()
+    
+    def reset(self):
+        """
+        Forget the time since the last run,
+        e.g. after sleeping while idle, so
+        it isn't caught up on.
+        """
+        self._accumulated = 0.0
+        self._last = time.perf_counter()
+    
+    def run(self, budget=0.0):
+        """
+        Run the step tasks for the time since
+        the last run, then the spare tasks until
+        budget seconds have passed since this
+        run started.
+        Returns the interpolation fraction.
+        """
+        now = time.perf_counter()
+        self._accumulated += now - self._last
+        self._last = now
+        
+        steps = 0
+        while self._accumulated >= self.timestep:
+            if steps == self.max_steps:
+                # Too far behind to catch up.
+                self._accumulated = 0.0
+                break
+            for task in self.step_tasks:
+                task(self.timestep)
+            self._accumulated -= self.timestep
+            steps += 1
+        
+        self.alpha = self._accumulated / self.timestep
+        
+        if self.spare_tasks:
+            deadline = now + budget
+            while time.perf_counter() < deadline:
+                for task in self.spare_tasks:
+                    task()
+        
+        return self.alpha
+
+# Icons scaled to the size they're
+# drawn at, keyed by (icon, size).
+icon_cache = SurfaceCache(4 * 1024 * 1024)
+
+def scaled_icon(icon, size):
+    """
+    Returns icon scaled to size. The
+    surface is shared, so it must
+    not be drawn on.
+    """
+    key = (icon, tuple(size))
+    
+    scaled = icon_cache.get(key)
+    if scaled is None:
+        scaled = pygame.transform.scale(icon, size)
+        icon_cache.put(key, scaled)
+    return scaled
+
+class GridIndex:
+    """
+    A spatial index over rectangles,
+    using a uniform grid of buckets.
+    Used to find the elements under a
+    point without checking every one.
+    """
+    def __init__(self, cell_size=64):
+        """
+        Initialises the index.
+        cell_size is the width and height
+        of each grid cell, in pixels.
+        """
+        self.cell_size = cell_size
+        
+        # (column, row) -> list of items
+        self._cells = {}
+        # item -> rect
+        self._rects = {}
+    
+    def __contains__(self, item):
+        return item in self._rects
+    
+    def _cells_for(self, rect):
+        cs = self.cell_size
+        for cx in range(rect.left // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1):
+                yield (cx, cy)
+    
+    def insert(self, item, rect):
+        """
+        Add an item covering rect.
+        """
+        rect = pygame.Rect(rect)
+        self._rects[item] = rect
+        for cell in self._cells_for(rect):
+            self._cells.setdefault(cell, []).append(item)
+    
+    def remove(self, item):
+        """
+        Remove an item from the index.
+        """
+        rect = self._rects.pop(item)
+        for cell in self._cells_for(rect):
+            bucket = self._cells[cell]
+            bucket.remove(item)
+            if not bucket:
+                del self._cells[cell]
+    
+    def rect_of(self, item):
+        """
+        Returns the rect an item was
+        indexed with, or None.
+        """
+        return self._rects.get(item)
+    
+    def move(self, item, rect):
+        """
+        Update the rect of an item
+        already in the index.
+        """
+        self.remove(item)
+        self.insert(item, rect)
+    
+    def clear(self):
+        """
+        Remove every item.
+        """
+        self._cells.clear()
+        self._rects.clear()
+    
+    def query_point(self, pos):
+        """
+        Returns a list of the items whose
+        rects contain pos, in no particular
+        order.
+        """
+        cs = self.cell_size
+        bucket = self._cells.get((int(pos[0]) // cs, int(pos[1]) // cs), ())
+        return [item for item in bucket
+                if self._rects[item].collidepoint(pos)]
+    
+    def query_rect(self, rect):
+        """
+        Returns a list of the items whose
+        rects overlap rect, in no particular
+        order.
+        """
+        rect = pygame.Rect(rect)
+        cs = self.cell_size
+        columns = (rect.right - 1) // cs - rect.left // cs + 1
+        rows = (rect.bottom - 1) // cs - rect.top // cs + 1
+        if columns * rows > len(self._cells):
+            # Cheaper to look at every
+            # bucket than every cell.
+            buckets = self._cells.values()
+        else:
+            buckets = [self._cells.get(cell, ())
+                       for cell in self._cells_for(rect)]
+        
+        found = set()
+        for bucket in buckets:
+            found.update(bucket)
+        return [item for item in found
+                if self._rects[item].colliderect(rect)]
+
+
+class ChildList(list):
+    """
+    A list of a container's children,
+    which tells the container whenever
+    it is modified.
+    """
+    def __init__(self, owner, children=()):
+        list.__init__(self, children)
+        self._owner = owner
+    
+    def _changed(self, old):
+        self._owner._children_changed(old)
+    
+    # Adding to the end is by far the most
+    # common change, and the container can
+    # deal with just the new children.
+    def append(self, child):
+        list.append(self, child)
+        self._owner._children_added(len(self) - 1)
+    
+    def extend(self, children):
+        start = len(self)
+        list.extend(self, children)
+        self._owner._children_added(start)
+    
+    def __iadd__(self, children):
+        self.extend(children)
+        return self
+
+def _notifying(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        # The container needs to know
+        # which children were removed.
+        old = list(self)
+        result = method(self, *args, **kwargs)
+        self._changed(old)
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__imul__'):
+    setattr(ChildList, _name, _notifying(_name))
+del _name
+
+
+# Events which are delivered to the
+# elements under the mouse pointer only.
+POINTER_EVENTS = (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP,
+                  pygame.MOUSEMOTION, pygame.MOUSEWHEEL)
+
+def merge_rects(rects):
+    """
+    Merges a list of rectangles so that
+    no two of the returned rectangles
+    overlap. Overlapping rectangles are
+    replaced by their union.
+    Returns a new list of pygame Rects.
+    """
+    merged = []
+    for r in rects:
+        r = pygame.Rect(r)
+        if not (r.w and r.h):
+            continue
+        
+        # Keep absorbing rectangles until
+        # nothing overlaps any more, since
+        # a union can grow into new neighbours.
+        i = r.collidelist(merged)
+        while i != -1:
+            r.union_ip(merged.pop(i))
+            i = r.collidelist(merged)
+        merged.append(r)
+    return merged
+
+
+class Layout(abc.ABC):
+    """
+    Positions the children of a container.
+    Each child is placed after the ones
+    before it, so adding a child to the end
+    only means placing that child.
+    """
+    def __init__(self, spacing=5, padding=5, reverse=False):
+        """
+        Initialises the layout.
+        spacing is the gap between children,
+        and padding the gap around them.
+        If reverse is True, children are placed
+        from the right or bottom edge of the
+        container instead, which must have
+        a size.
+        """
+        self.spacing = spacing
+        self.padding = padding
+        self.reverse = reverse
+    
+    @abc.abstractmethod
+    def place(self, container, first):
+        """
+        Position container.children[first:],
+        given that the children before them
+        are already in place.
+        """
+
+
+class Row(Layout):
+    """
+    Places children left to right,
+    along their top edges.
+    """
+    def place(self, container, first):
+        children = container.children
+        x = self.padding
+        if first > 0:
+            before = children[first - 1]
+            if self.reverse:
+                x = container.size[0] - before.pos[0] + self.spacing
+            else:
+                x = before.pos[0] + before.size[0] + self.spacing
+        
+        for c in children[first:]:
+            width = c.size[0]
+            if self.reverse:
+                c.pos = [container.size[0] - x - width, self.padding]
+            else:
+                c.pos = [x, self.padding]
+            x += width + self.spacing
+
+
+class Column(Layout):
+    """
+    Places children top to bottom,
+    along their left edges.
+    """
+    def place(self, container, first):
+        children = container.children
+        y = self.padding
+        if first > 0:
+            before = children[first - 1]
+            if self.reverse:
+                y = container.size[1] - before.pos[1] + self.spacing
+            else:
+                y = before.pos[1] + before.size[1] + self.spacing
+        
+        for c in children[first:]:
+            height = c.size[1]
+            if self.reverse:
+                c.pos = [self.padding, container.size[1] - y - height]
+            else:
+                c.pos = [self.padding, y]
+            y += height + self.spacing
+
+
+class Grid(Layout):
+    """
+    Places children in the cells of a
+    grid, filling each row in turn.
+    Where a child goes depends only on
+    its index, so changing one child
+    never moves the others.
+    """
+    def __init__(self, columns, cell_size=(50,50), spacing=0, padding=0,
+                 reverse=False):
+        """
+        Initialises the grid.
+        columns is the number of cells in a
+        row, and cell_size the (width, height)
+        of each cell. If reverse is True,
+        the grid fills from the bottom right,
+        leftwards and then upwards.
+        """
+        Layout.__init__(self, spacing, padding, reverse)
+        self.columns = columns
+        self.cell_size = tuple(cell_size)
+    
+    def place(self, container, first):
+        width, height = self.cell_size
+        for i, c in enumerate(container.children[first:], first):
+            row, column = divmod(i, self.columns)
+            x = self.padding + column * (width + self.spacing)
+            y = self.padding + row * (height + self.spacing)
+            if self.reverse:
+                x = container.size[0] - x - width
+                y = container.size[1] - y - height
+            c.pos = [x, y]
+
 
 
 class BaseUIElement:
+    # Widgets use __slots__ to keep their
+    # memory down, since there may be
+    # thousands of them.
+    __slots__ = ('_pos', '_visible', '_last_rect', '_dirty', '_parent',
+                 '__weakref__')
+    
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        # A weak reference to the container
+        # holding the element, if any.
+        self._parent = None
+        # The region last drawn by the element,
+        # or None if it hasn't been drawn.
+        self._last_rect = None
+        # Set whenever the element's appearance
+        # changes in a way that isn't visible
+        # from its rectangle alone.
+        self._dirty = True
+        return self
+    
     def __init__(self):
         """
         Initialises the object.
         """
         pass
     
+    @property
+    def pos(self):
+        """
+        The position of the element's top
+        left corner, relative to its parent.
+        Assign a new position rather than
+        changing this list in place, so that
+        the move is seen.
+        """
+        return self._pos
+    
+    @pos.setter
+    def pos(self, pos):
+        self._pos = list(pos)
+        self._report_change()
+        self.invalidate_layout()
+    
+    @property
+    def visible(self):
+        """
+        Whether the element is drawn.
+        """
+        return self._visible
+    
+    @visible.setter
+    def visible(self, visible):
+        self._visible = visible
+        self._report_change()
+    
     def update(self):
         """
         An update function.
@@ -49,6 +851,18 @@ class BaseUIElement:
         regardless of visibility.
         """
         pass
+    
+    def is_animating(self):
+        """
+        Whether the element will change
+        its appearance without any further
+        input, e.g. because an animation
+        or ink ripple is still playing.
+        If this is False for every element,
+        the main loop can safely sleep
+        until the next event arrives.
+        """
+        return False
         
     def collide(self, pos):
         """
@@ -67,8 +881,111 @@ class BaseUIElement:
         """
         Render the element onto
         the surface given.
+        Returns the rectangle that was
+        drawn to, or None if nothing was.
         """
         pass
+    
+    def get_rect(self):
+        """
+        Returns the rectangle, relative
+        to the parent, that the element
+        may draw to.
+        """
+        return pygame.Rect(self.pos, self.size)
+    
+    def invalidate_layout(self):
+        """
+        Tell the container holding the element
+        that it has moved or resized, so that
+        its layout and size are worked out
+        again. Setting pos or size does this
+        already; call it after changing pos
+        in place.
+        """
+        parent = self._parent and self._parent()
+        if parent is not None:
+            parent._child_moved(self)
+    
+    def _notify(self, callback, *args):
+        """
+        Call callback(self, *args) to report a
+        change, unless a container holding the
+        element is in the middle of a batch, in
+        which case it's noted there instead.
+        """
+        ref = self._parent
+        while ref is not None:
+            parent = ref()
+            if parent is None:
+                break
+            if parent._batch is not None:
+                parent._batch.add(self)
+                return
+            ref = parent._parent
+        callback(self, *args)
+    
+    def _report_change(self):
+        """
+        Tell the container holding the element
+        that it has something to redraw, so
+        that it's looked at when the dirty
+        rects are next collected. Containers
+        only look at the children which did.
+        """
+        parent = self._parent and self._parent()
+        if parent is not None:
+            parent._child_changed(self)
+    
+    def _still_changing(self):
+        """
+        Whether the element should be looked at
+        again on the next frame, without having
+        to report it, e.g. because it is part
+        way through an animation.
+        """
+        return self.is_animating()
+    
+    def mark_dirty(self):
+        """
+        Force the element to be redrawn
+        on the next frame. Call this after
+        changing a plain attribute such as
+        a colour.
+        """
+        self._dirty = True
+        self._report_change()
+    
+    def is_dirty(self):
+        """
+        Whether the element's appearance
+        has changed since it was last drawn.
+        """
+        return self._dirty
+    
+    def _drawn_rects(self):
+        """
+        Returns a list of the rectangles,
+        relative to the parent, which the
+        element last drew to.
+        """
+        return [self._last_rect] if self._last_rect else []
+    
+    def get_dirty_rects(self):
+        """
+        Returns a list of the rectangles,
+        relative to the parent, which need
+        to be redrawn this frame.
+        This includes the region the element
+        previously occupied if it has moved,
+        resized or been hidden.
+        """
+        rect = self.get_rect() if self.visible else None
+        
+        if rect == self._last_rect and not (rect and self.is_dirty()):
+            return []
+        
+        return [r for r in (self._last_rect, rect) if r]
 
 
 class Checkbox(BaseUIElement):
@@ -77,6 +994,19 @@ class Checkbox(BaseUIElement):
     """
     check_mask = pygame.image.load('icons/check_mask.png').convert_alpha()
     
+    # Rendered checkbox frames, shared
+    # between all checkboxes which look
+    # the same.
+    frame_cache = SurfaceCache(16 * 1024 * 1024)
+    # The number of distinct frames
+    # in the check animation.
+    anim_steps = 32
+    
+    __slots__ = ('_checked', '_anim', '_icon', '_size', '_radius',
+                 'colour', 'bg_colour', 'outline_colour', 'outline_width',
+                 'fill_type', 'ink', 'ink_duration', 'anim_duration',
+                 'onchange', '_inks', '_drawn_progress')
+    
     def __init__(self, pos, **kwargs):
         """
         Initialises the checkbox object.
@@ -123,7 +1053,9 @@ class Checkbox(BaseUIElement):
                     which is called every time the checkbox is
                     pressed. If the checkbox is changed
                     programmatically, the mouse click position
-                    is 'None'.
+                    is 'None'. Not called for changes made in
+                    a batch of a container holding the
+                    checkbox; see Container.batch.
           anim_duration: The duration of the animation.
                          Default 0.15 (seconds)
           ink_duration: The duration of the ink ripples.
@@ -134,9 +1066,11 @@ class Checkbox(BaseUIElement):
         # by default unchecked
         self._checked = kwargs.get('checked',False)
         
-        # 1.0 if checked else 0.0
+        # The check animation's slot in the
+        # animator, holding 1.0 if checked
+        # else 0.0 once it finishes.
         # bool is a subclass of int
-        self._animprogress = float(self.checked)
+        self._anim = animator.add(float(self.checked))
         
         self._icon = kwargs.get('icon',Checkbox.check_mask)
         
@@ -158,30 +1092,22 @@ class Checkbox(BaseUIElement):
         # Store ink ripples
         self._inks = []
         
+        # The animation progress as of
+        # the last draw
+        self._drawn_progress = None
+        
     @property
     def size(self):
-        return self._tmp.get_size()
+        return self._size
     
     @size.setter
     def size(self, size):
-        self._tmp = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._tmp = self._tmp.convert_alpha()
-        
-        self._innertmp = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._innertmp = self._innertmp.convert_alpha()
-        
-        self._check_mask = pygame.Surface([min(size)]*2,
-                                          pygame.SRCALPHA, 32)
-        self._check_mask = self._check_mask.convert_alpha()
+        self._size = tuple(size)
         
         self._radius = min(size)
         
-        self._inktmp = pygame.Surface([int(self._radius*2)]*2,
-                                      pygame.SRCALPHA, 32)
-        self._inktmp = self._inktmp.convert_alpha()
-        
-        pygame.transform.scale(self._icon,[min(size)]*2,
-                               self._check_mask)
+        self.mark_dirty()
+        self.invalidate_layout()
     
     @property
     def icon(self):
@@ -191,8 +1117,7 @@ class Checkbox(BaseUIElement):
     def icon(self, icon):
         self._icon = icon
         
-        pygame.transform.scale(self,_icon,[min(self,size)]*2,
-                               self._check_mask)
+        self.mark_dirty()
                                
     @property
     def checked(self):
@@ -200,20 +1125,29 @@ class Checkbox(BaseUIElement):
     
     @checked.setter
     def checked(self, checked):
+        checked = bool(checked)
         if checked != self._checked:
             # Programmatic change.
-            self.onchange(self, None)
-        
-    def update(self):
-        # Update animation progress
-        
-        # We divide by the number of
-        # frames per second to get
-        # a smooth animation going.
-        self._animprogress += (float(self.checked)*2-1) / (get_fps() * self.anim_duration)
-        
-        # Clip to range [0.0,1.0]
-        self._animprogress = min(max(0.0,self._animprogress),1.0)
+            self._checked = checked
+            self._animate()
+            self._notify(self.onchange, None)
+        
+    def __del__(self):
+        # __init__ may not have got this far
+        slot = getattr(self, '_anim', None)
+        if slot is not None:
+            animator.remove(slot)
+    
+    @property
+    def _animprogress(self):
+        # The animator moves this towards
+        # checked, once per frame.
+        return animator.shown[self._anim]
+    
+    def _animate(self):
+        animator.animate(self._anim, float(self._checked),
+                         self.anim_duration)
+        self._report_change()
         
     def collide(self, pos):
         if not self.visible:
@@ -222,6 +1156,42 @@ class Checkbox(BaseUIElement):
         return 0 <= pos[0]-(self.pos[0]) < self.size[0] and \
                0 <= pos[1]-(self.pos[1]) < self.size[1]
     
+    def get_rect(self):
+        rect = pygame.Rect(self.pos, self.size)
+        if self.ink:
+            # Ink ripples spill out past
+            # the edges of the checkbox.
+            ink_rect = pygame.Rect(0, 0, self._radius*2, self._radius*2)
+            ink_rect.center = rect.center
+            rect.union_ip(ink_rect)
+        return rect
+    
+    def is_dirty(self):
+        return self._dirty or bool(self._inks) or \
+               self._animprogress != self._drawn_progress
+    
+    def _expire_inks(self):
+        """
+        Forget the ink ripples which have
+        finished, as drawing does, in case
+        the checkbox isn't being drawn (e.g.
+        it is hidden). Returns whether any
+        were forgotten.
+        """
+        end = get_time() - self.ink_duration*1000
+        inks = [t for t in self._inks if t >= end]
+        if len(inks) == len(self._inks):
+            return False
+        self._inks = inks
+        # One more frame, to wipe them
+        # off if they were drawn.
+        self.mark_dirty()
+        return True
+    
+    def is_animating(self):
+        return self._expire_inks() or bool(self._inks) or \
+               animator.is_animating(self._anim)
+    
     def create_ink(self):
         """
         Generate an ink ripple on command.
@@ -230,6 +1200,7 @@ class Checkbox(BaseUIElement):
         """
         if self.ink:
             self._inks.append(get_time())
+            self._report_change()
             
     def toggle(self, ink = True):
         """
@@ -242,10 +1213,11 @@ class Checkbox(BaseUIElement):
         be created.)
         """
         self._checked ^= True
+        self._animate()
         if ink: self.create_ink()
         
         # call the onchange function
-        self.onchange(self, None)
+        self._notify(self.onchange, None)
         
     def handle_event(self, event, mousepos):
         if not self.visible:
@@ -255,65 +1227,105 @@ class Checkbox(BaseUIElement):
         if event.type == pygame.MOUSEBUTTONUP and \
            self.collide(mousepos):
             self._checked ^= True
+            self._animate()
             self.create_ink()
             
-            self.onchange(
-                self,
+            self._notify(
+                self.onchange,
                 (mousepos[0] - self.pos[0],
                  mousepos[1] - self.pos[1])
             )
 
-    def draw(self, surface):
-        if not self.visible:
-            return
-        
+    def _render_frame(self, progress):
+        """
+        Render the checkbox itself (without
+        ink) at the given animation progress.
+        Returns a new surface.
+        """
         # We use the animation progress to fill the Checkbox
         # with a certain opacity.
         
+        frame = pygame.Surface(self.size, pygame.SRCALPHA, 32)
+        frame = frame.convert_alpha()
+        
+        innertmp = surface_pool.acquire(self.size)
+        check_mask = scaled_icon(self._icon, [min(self.size)]*2)
+        
+        inner_rect = (self.outline_width,self.outline_width,
+                      self.size[0] - 2*self.outline_width,
+                      self.size[1] - 2*self.outline_width)
+        
         # Draw checkbox outline
-        self._tmp.fill(self.outline_colour)
+        frame.fill(self.outline_colour)
         
         BLIT_ICON = True
         
         if self.fill_type == "background":
             # Draw background colour, mixed with
             # foreground colour
-            self._tmp.fill(colour_mix(self.bg_colour,self.colour,self._animprogress),
-                      (self.outline_width,self.outline_width,
-                       self.size[0] - 2*self.outline_width,
-                       self.size[1] - 2*self.outline_width))
+            frame.fill(colour_mix(self.bg_colour,self.colour,progress),
+                       inner_rect)
                        
-            self._innertmp.fill(self.bg_colour)
-            self._innertmp.blit(self._check_mask, (0,0),
-                                None, pygame.BLEND_RGBA_MULT)
+            innertmp.fill(self.bg_colour)
+            innertmp.blit(check_mask, (0,0),
+                          None, pygame.BLEND_RGBA_MULT)
         elif self.fill_type == "icon":
             # Draw background colour
-            self._tmp.fill(self.bg_colour,
-                      (self.outline_width,self.outline_width,
-                       self.size[0] - 2*self.outline_width,
-                       self.size[1] - 2*self.outline_width))
+            frame.fill(self.bg_colour, inner_rect)
                        
             # Draw a circle that is masked by the check mask icon
             # If we're at the start or end of the animation,
             # we optimise.
             
-            if self._animprogress == 1.0:
+            if progress == 1.0:
                 # We're at the end
                 # Just draw the checkmark icon
-                self._innertmp.fill(self.colour)
-                self._innertmp.blit(self._check_mask, (0,0),
-                                    None, pygame.BLEND_RGBA_MULT)
-            elif self._animprogress == 0.0:
+                innertmp.fill(self.colour)
+                innertmp.blit(check_mask, (0,0),
+                              None, pygame.BLEND_RGBA_MULT)
+            elif progress == 0.0:
                 # Well, nothing to do here
                 BLIT_ICON=False
             else:
-                self._innertmp.fill((255,255,255,0))
-                pygame.draw.circle(self._innertmp, self.colour,
+                innertmp.fill((255,255,255,0))
+                pygame.draw.circle(innertmp, self.colour,
                                    (self.size[0]//2,self.size[1]//2),
-                                   int(self._radius*self._animprogress)
+                                   int(self._radius*progress)
                                    )
-                self._innertmp.blit(self._check_mask, (0,0),
-                                    None, pygame.BLEND_RGBA_MULT)
+                innertmp.blit(check_mask, (0,0),
+                              None, pygame.BLEND_RGBA_MULT)
+        
+        # Draw checkbox icon
+        if BLIT_ICON:
+            frame.blit(innertmp, inner_rect[:2], inner_rect)
+        
+        surface_pool.release(innertmp)
+        return frame
+    
+    def _get_frame(self):
+        """
+        Returns the checkbox's current frame,
+        from the shared cache if possible.
+        """
+        # Quantize the animation progress so
+        # that checkboxes part way through
+        # their animations can share frames.
+        step = int(round(self._animprogress * Checkbox.anim_steps))
+        
+        key = (self.size, tuple(self.colour), tuple(self.bg_colour),
+               tuple(self.outline_colour), self.outline_width,
+               self.fill_type, self._icon, step)
+        
+        frame = Checkbox.frame_cache.get(key)
+        if frame is None:
+            frame = self._render_frame(step / Checkbox.anim_steps)
+            Checkbox.frame_cache.put(key, frame)
+        return frame
+
+    def draw(self, surface):
+        if not self.visible:
+            self._last_rect = None
+            return
         
         # Draw ink ripples
         if self.ink:
@@ -328,41 +1340,38 @@ class Checkbox(BaseUIElement):
                     # in time calculations.
                     # just pretend nothing happened...
                     continue
-                self._inktmp.fill((255,255,255,0))
-                pygame.draw.circle(self._inktmp, self.colour[:3]+
-                                   [255 - int(255 * 
-                                              (curr_time-t) / 
-                                              (self.ink_duration*1000)
-                                              )],
-                                   [int(self._radius)]*2,
-                                   int(self._radius/2+
-                                       (self._radius/2)*
-                                       # Deceleration curve
-                                       math.sqrt(
-                                            (curr_time-t)/
-                                            (self.ink_duration*1000)
-                                            )
-                                       )
-                                   )
-                surface.blit(self._inktmp,
-                             [self.pos[0] - self._radius + self.size[0]//2,
-                              self.pos[1] - self._radius + self.size[1]//2])
+                draw_ink(surface,
+                         [self.pos[0] - self._radius + self.size[0]//2,
+                          self.pos[1] - self._radius + self.size[1]//2],
+                         self._radius, self.colour,
+                         (curr_time-t) / (self.ink_duration*1000))
             self._inks = newinks
             
         # Draw main checkbox
-        surface.blit(self._tmp,self.pos)
-        # Draw checkbox icon
-        if BLIT_ICON:
-            surface.blit(self._innertmp,
-                         (self.pos[0]+self.outline_width,self.pos[1]+self.outline_width),
-                         (self.outline_width,self.outline_width,
-                          self.size[0]-2*self.outline_width,self.size[1]-2*self.outline_width))
+        surface.blit(self._get_frame(), self.pos)
+        
+        self._drawn_progress = self._animprogress
+        self._dirty = False
+        self._last_rect = self.get_rect()
+        return self._last_rect
                           
 
 class Container(BaseUIElement):
     """
     A container for other elements.
+    
+    It keeps what it composed from its
+    children between frames, and only
+    recomposes the parts they report as
+    changed, so a panel that isn't
+    changing costs one blit to draw.
     """
+    __slots__ = ('_size', 'retained', '_index', '_children',
+                 '_index_stale', '_index_synced', '_moved', '_child_order',
+                 '_surface', '_invalid', '_pending', '_collected',
+                 '_removed', '_reported', '_autosizing', 'layout', 'fit',
+                 '_layout_from', '_extent', 'onchange', '_batch')
+    
     def __init__(self, pos, **kwargs):
         """
         Initialises the Container object.
@@ -371,21 +1380,359 @@ class Container(BaseUIElement):
           children: The container's children.
           visible: Whether the container is
                    visible or not.
+          index_cell_size: The cell size of the
+                           spatial index used to
+                           find the children under
+                           the mouse (or in the way
+                           of a redraw). Default 64px.
+          retained: Whether to keep the composed
+                    children between frames. If
+                    False, they are composed onto
+                    a borrowed scratch surface
+                    each time, which saves memory
+                    for big, busy containers.
+                    Default True.
+          layout: A Layout (e.g. Row, Column or
+                  Grid) to position the children,
+                  or None to position them by
+                  hand. Default None.
+          fit: If given, the container keeps
+               itself just big enough for its
+               children, plus this margin on the
+               right and bottom, instead of
+               having a fixed size.
+          onchange: A function taking two arguments,
+                    the container and the set of
+                    elements changed, which is called
+                    at the end of every batch in which
+                    something changed. See batch.
         """
         self.pos = list(pos)
         
+        self.onchange = kwargs.get('onchange', lambda x,y: 0)
+        # The elements changed so far in the
+        # current batch, or None if there
+        # isn't one.
+        self._batch = None
+        
+        self.layout = kwargs.get('layout')
+        self.fit = kwargs.get('fit')
+        # The first child whose position (or
+        # anything after it) may have changed
+        # since the last layout, or None.
+        self._layout_from = None
+        # (right, bottom, n, x edge, y edge), the
+        # furthest extent of the first n children
+        # and the indices of the children which
+        # reach it, or None.
+        self._extent = None
+        
+        # The composed children, and the parts
+        # of it (in our own coordinates) to
+        # compose again. None means all of it.
+        self._surface = None
+        self._invalid = None
+        # Children which reported changes. They
+        # are drawn even if they're outside the
+        # area being drawn (e.g. off screen, or
+        # just hidden), so they know they're
+        # up to date.
+        self._pending = []
+        # Whether get_dirty_rects has been called
+        # since the last update, so the changes
+        # are already in _invalid.
+        self._collected = False
+        # Where removed children were drawn, to
+        # be reported with the children's rects.
+        self._removed = []
+        # The children to look at when the dirty
+        # rects are next collected: those which
+        # reported a change, or are animating.
+        self._reported = set()
+        
+        self.retained = kwargs.get('retained', True)
         self.size = kwargs.get('size',(300,300))
+        self._index = GridIndex(kwargs.get('index_cell_size', 64))
+        # Children which may have moved since
+        # the spatial index was last updated.
+        self._moved = set()
+        # The children with an autosize of
+        # their own, for autosize(recurse=True).
+        self._autosizing = []
         self.children = kwargs.get('children',[])
         self.visible = kwargs.get('visible',True)
     
+    @property
+    def children(self):
+        return self._children
+    
+    @children.setter
+    def children(self, children):
+        old = getattr(self, '_children', ())
+        self._children = ChildList(self, children)
+        self._children_changed(old)
+    
+    def _children_changed(self, old=()):
+        """
+        Deal with any change to the children
+        other than appending. old is the list
+        of children before the change.
+        """
+        # Rebuild the spatial index
+        # the next time it is needed.
+        self._index_stale = True
+        
+        # The drawing order may have
+        # changed, so start afresh.
+        self.mark_dirty()
+        
+        ref = weakref.ref(self)
+        for c in self._children:
+            c._parent = ref
+        self._reported = set(self._children)
+        self._autosizing = [c for c in self._children
+                            if hasattr(c, 'autosize')]
+        
+        # A removed child doesn't report where
+        # it was drawn, so note that for it.
+        # (This matters when we have no
+        # background to redraw, e.g. for an
+        # UnboundedContainer.)
+        current = set(self._children)
+        for c in old:
+            if c not in current:
+                self._removed.extend(c._drawn_rects())
+                if c._parent is ref:
+                    # Wherever it goes next, it
+                    # hasn't been drawn there.
+                    c._parent = None
+                    c._last_rect = None
+        self._extent = None
+        self._request_layout(0)
+    
+    def _children_added(self, start):
+        """
+        Deal with children appended from
+        index start, without looking at
+        any of the others.
+        """
+        ref = weakref.ref(self)
+        new = self._children[start:]
+        for i, c in enumerate(new, start):
+            c._parent = ref
+            if not self._index_stale:
+                self._index.insert(c, c.get_rect())
+                self._child_order[c] = i
+        # New children report their own rects
+        # to be drawn, so nothing else needs
+        # to be redrawn.
+        self._reported.update(new)
+        self._report_change()
+        self._autosizing.extend(c for c in new if hasattr(c, 'autosize'))
+        self._request_layout(start)
+    
+    def _child_moved(self, child):
+        """
+        Called by invalidate_layout.
+        """
+        if self._index_stale:
+            self._sync_index()
+        i = self._child_order.get(child)
+        if i is None:
+            # No longer one of ours
+            return
+        self._moved.add(child)
+        if self._extent is not None and i < self._extent[2]:
+            maxx, maxy, n, xedge, yedge = self._extent
+            right = child.pos[0]+child.size[0]
+            bottom = child.pos[1]+child.size[1]
+            if (i == xedge and right < maxx) or \
+               (i == yedge and bottom < maxy):
+                # It pulled in an edge, which some
+                # other child may now define.
+                self._extent = None
+            else:
+                # Any other change can only
+                # push the edges out.
+                if right >= maxx:
+                    maxx, xedge = right, i
+                if bottom >= maxy:
+                    maxy, yedge = bottom, i
+                self._extent = (maxx, maxy, n, xedge, yedge)
+        self._request_layout(i)
+    
+    def _child_changed(self, child):
+        """
+        Called by _report_change.
+        """
+        if not self._reported:
+            # The first since we were last looked
+            # at, so we need looking at too.
+            self._report_change()
+        self._reported.add(child)
+    
+    def _still_changing(self):
+        return bool(self._reported)
+    
+    def _request_layout(self, first):
+        if self._layout_from is None or first < self._layout_from:
+            self._layout_from = first
+    
+    def _content_extent(self):
+        """
+        Returns (right, bottom), the furthest
+        any child reaches, only looking at
+        the children not already counted.
+        """
+        maxx, maxy, n, xedge, yedge = self._extent or (0, 0, 0, -1, -1)
+        for i in range(n, len(self._children)):
+            c = self._children[i]
+            if c.pos[0]+c.size[0] > maxx:
+                maxx, xedge = c.pos[0]+c.size[0], i
+            if c.pos[1]+c.size[1] > maxy:
+                maxy, yedge = c.pos[1]+c.size[1], i
+        self._extent = (maxx, maxy, len(self._children), xedge, yedge)
+        return maxx, maxy
+    
+    def relayout(self):
+        """
+        Bring the children's positions (if
+        there is a layout) and our size (if
+        we fit our children) up to date. This
+        happens once per frame, in update, so
+        it's only needed to see the results
+        straight away.
+        Only the children from the first one
+        which changed onwards are placed.
+        """
+        first = self._layout_from
+        if first is None:
+            return
+        self._layout_from = None
+        
+        if self.layout is not None and first < len(self._children):
+            self.layout.place(self, first)
+            # (Placing them asked for this again.)
+            self._layout_from = None
+            self._moved.update(self._children[first:])
+            if self._extent is not None and self._extent[2] > first:
+                # Children we'd counted have moved. If
+                # the ones reaching furthest weren't
+                # among them, just count them again.
+                maxx, maxy, n, xedge, yedge = self._extent
+                if xedge < first and yedge < first:
+                    self._extent = (maxx, maxy, first, xedge, yedge)
+                else:
+                    self._extent = None
+        
+        if self.fit is not None:
+            maxx, maxy = self._content_extent()
+            self.size = (maxx + self.fit, maxy + self.fit)
+    
+    def mark_dirty(self):
+        self._invalid = None
+        self._dirty = True
+        self._report_change()
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Make many changes to the elements in
+        the container as one. Within the with
+        block, the elements' own change
+        callbacks (e.g. a Checkbox's onchange)
+        aren't called. Instead, the container's
+        onchange is called once at the end with
+        the set of elements which changed.
+        For example:
+            with container.batch():
+                for c in container.children:
+                    c.checked = False
+        A batch inside another batch of the
+        same container is part of it.
+        """
+        if self._batch is not None:
+            yield
+            return
+        
+        self._batch = set()
+        try:
+            yield
+        finally:
+            changed, self._batch = self._batch, None
+            if changed:
+                self.onchange(self, changed)
+    
+    def reindex(self, child=None):
+        """
+        Update the spatial index after a
+        child has moved or been resized.
+        This happens automatically for children
+        which report it (see invalidate_layout)
+        or which are redrawn because of it, so
+        it's only needed if a child is moved by
+        hand in between two events in the same
+        frame.
+        If child is None, every child is
+        checked.
+        """
+        if child is None:
+            self._index_synced = False
+            self._sync_index()
+        elif child in self._index:
+            self._index.move(child, child.get_rect())
+    
+    def _sync_index(self):
+        """
+        Bring the spatial index up to date
+        with the children's positions.
+        """
+        if self._index_stale:
+            self._index.clear()
+            for c in self.children:
+                self._index.insert(c, c.get_rect())
+            self._child_order = {c: i for i, c in enumerate(self.children)}
+            self._index_stale = False
+        else:
+            # Only the children known to have moved,
+            # unless we've been told to check them all.
+            moved = self._moved if self._index_synced else self.children
+            for c in moved:
+                # (It may have been removed since.)
+                if c in self._index:
+                    rect = c.get_rect()
+                    if rect != self._index.rect_of(c):
+                        self._index.move(c, rect)
+        self._moved.clear()
+        self._index_synced = True
+    
+    def children_at(self, pos):
+        """
+        Returns the children whose rects
+        contain pos (relative to this
+        container), in drawing order.
+        """
+        self._sync_index()
+        return sorted(self._index.query_point(pos),
+                      key=self._child_order.__getitem__)
+    
     @property
     def size(self):
-        return self.surface.get_size()
+        return self._size
     
     @size.setter
     def size(self, size):
-        self.surface = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self.surface = self.surface.convert_alpha()
+        size = tuple(size)
+        if size == getattr(self, '_size', None):
+            return
+        self._size = size
+        
+        self.mark_dirty()
+        self.invalidate_layout()
+        # Children placed from the right
+        # or bottom edge have to move.
+        if self.layout is not None and self.layout.reverse:
+            self._request_layout(0)
         
     def autosize(self, margin=5, recurse=False):
         """
@@ -410,21 +1757,62 @@ class Container(BaseUIElement):
         Defaults to False.
         """
         
-        maxx = 0
-        maxy = 0
-        
-        for c in self.children:
-            if recurse and hasattr(c, "autosize"):
+        if recurse:
+            # Only the children which have an
+            # autosize, not every child.
+            for c in self._autosizing:
                 c.autosize(margin, recurse)
-            maxx = max(maxx, c.pos[0]+c.size[0])
-            maxy = max(maxy, c.pos[1]+c.size[1])
+        
+        # The furthest extent of the children
+        # is kept between calls, and only
+        # worked out again once they change
+        # (including when pos is assigned).
+        self.relayout()
+        maxx, maxy = self._content_extent()
         
         self.size = [maxx+margin, maxy+margin]
     
         
+    def _live_children(self):
+        """
+        The children which are updated, drawn
+        and sent events: all of them, here.
+        """
+        return self._children
+    
+    def _children_in(self, rect):
+        """
+        Returns the children whose rects
+        overlap rect, in no particular order.
+        """
+        self._sync_index()
+        return self._index.query_rect(rect)
+    
     def update(self):
-        for c in self.children:
-            c.update()
+        for c in self._live_children():
+            # Skip the call for children which
+            # don't update themselves, e.g.
+            # Checkboxes, which the animator
+            # looks after.
+            if type(c).update is not BaseUIElement.update:
+                c.update()
+        
+        # After the children, since child
+        # containers may have resized.
+        self.relayout()
+        
+        self._collected = False
+    
+    def is_animating(self):
+        # Children update even while hidden,
+        # so visibility doesn't matter here.
+        # A child which starts animating reports
+        # itself, and stays reported until it
+        # stops, so only those need asking.
+        for c in list(self._reported):
+            if c.is_animating():
+                return True
+        return False
     
     def handle_event(self, event, mousepos):
         if not self.visible:
@@ -438,29 +1826,180 @@ class Container(BaseUIElement):
             # If the mouse position
             # is outside this container,
             # we don't want to handle the click.
-            if not (0 <= mousepos[0] < self.size[0] and
-                    0 <= mousepos[1] < self.size[1]):
+            if not (0 <= mousepos[0]-self.pos[0] < self.size[0] and
+                    0 <= mousepos[1]-self.pos[1] < self.size[1]):
                 return
         
-        for c in self.children:
-            # We subtract our current pos because
-            # our children are relatively positioned.
-            c.handle_event(event, 
-                           [mousepos[0]-self.pos[0], mousepos[1]-self.pos[1]])
+        # We subtract our current pos because
+        # our children are relatively positioned.
+        relpos = [mousepos[0]-self.pos[0], mousepos[1]-self.pos[1]]
+        
+        if event.type in POINTER_EVENTS:
+            # Only the children under the
+            # pointer can be interested.
+            children = self.children_at(relpos)
+        else:
+            children = list(self._live_children())
+        
+        for c in children:
+            c.handle_event(event, relpos)
     
     def __getitem__(self, key):
         return self.children[key]
-
+    
+    def _child_dirty_rects(self):
+        """
+        Returns the rects, relative to us,
+        which our children need redrawn,
+        and notes them to be recomposed.
+        This is how a change in a child
+        works its way up through nested
+        containers to the one drawing
+        onto the screen.
+        """
+        rects, self._removed = self._removed, []
+        # Only the children which reported a
+        # change, so a subtree where nothing
+        # changed isn't looked at at all.
+        reported, self._reported = self._reported, set()
+        for c in reported:
+            child_rects = c.get_dirty_rects()
+            if child_rects:
+                self._pending.append(c)
+                # It may have moved.
+                self._moved.add(c)
+                rects.extend(child_rects)
+            if c._still_changing():
+                self._reported.add(c)
+        self._collected = True
+        
+        if self._invalid is not None:
+            bounds = pygame.Rect((0, 0), self.size)
+            self._invalid.extend(r.clip(bounds) for r in rects)
+            if len(self._invalid) > 256:
+                # We aren't being drawn (e.g. our
+                # parent clips us), so rather than
+                # keep every rect, redo the lot.
+                self._invalid = None
+        return rects
+    
+    def get_dirty_rects(self):
+        rects = BaseUIElement.get_dirty_rects(self)
+        if not self.visible:
+            return rects
+        
+        bounds = self.get_rect()
+        for r in self._child_dirty_rects():
+            # Convert to our parent's coordinates,
+            # and discard anything we would clip.
+            r = r.move(self.pos).clip(bounds)
+            if r.w and r.h:
+                rects.append(r)
+        return rects
+    
+    def draw_dirty(self, surface, bg_colour=(255,255,255)):
+        """
+        Redraw only the parts of the container
+        which have changed since the last call.
+        Each changed region is cleared to bg_colour
+        and every element overlapping it is redrawn.
+        Returns the list of rectangles drawn to,
+        suitable for pygame.display.update.
+        
+        The surface is assumed to hold the previous
+        frame, so it must have been filled (or fully
+        drawn) once beforehand.
+        """
+        rects = merge_rects(self.get_dirty_rects())
+        
+        old_clip = surface.get_clip()
+        for r in rects:
+            surface.set_clip(r)
+            surface.fill(bg_colour)
+            self.draw(surface)
+        surface.set_clip(old_clip)
+        
+        return rects
+    
+    def _draw_children(self, surface):
+        """
+        Draw every child which overlaps the
+        surface's clipping area, found with
+        the spatial index rather than by
+        checking every child.
+        """
+        children = set(self._children_in(surface.get_clip()))
+        children.update(c for c in self._pending if c in self._child_order)
+        self._pending = []
+        
+        for c in sorted(children, key=self._child_order.__getitem__):
+            c.draw(surface)
+    
+    def _compose(self, area):
+        """
+        Bring the retained surface up to date
+        for the given area (in our own
+        coordinates) and everything the
+        children reported as changed.
+        """
+        if self._surface is None or self._surface.get_size() != self.size:
+            self._surface = pygame.Surface(self.size).convert()
+            self._invalid = None
+        
+        if self._invalid is None:
+            regions = [self._surface.get_rect()]
+        else:
+            if not self._collected:
+                # get_dirty_rects wasn't called this
+                # frame (e.g. on a full redraw), so
+                # find the changes in the area here.
+                for c in self._children_in(area):
+                    self._invalid.extend(c.get_dirty_rects())
+                self._collected = True
+            regions = merge_rects(self._invalid)
+        self._invalid = []
+        
+        for r in regions:
+            self._surface.set_clip(r)
+            self._surface.fill((255,255,255))
+            self._draw_children(self._surface)
+        self._surface.set_clip(None)
+    
     def draw(self, surface):
         if not self.visible:
+            self._last_rect = None
             return
-            
-        self.surface.fill((255,255,255))
         
-        for c in self.children:
-            c.draw(self.surface)
+        rect = self.get_rect()
+        
+        # Only the part of our surface which
+        # will actually make it through the
+        # clipping area of the destination.
+        area = surface.get_clip().clip(rect).move(-self.pos[0], -self.pos[1])
+        
+        if self.retained:
+            self._compose(area)
+            surface.blit(self._surface, (self.pos[0] + area.x,
+                                         self.pos[1] + area.y), area)
+        else:
+            # Compose onto a scratch surface
+            # borrowed just for this draw.
+            self._surface = None
+            self._invalid = None
+            scratch = surface_pool.acquire(self.size)
+            scratch.set_clip(area)
+            
+            scratch.fill((255,255,255))
+            self._draw_children(scratch)
+            
+            scratch.set_clip(None)
+            
+            surface.blit(scratch,self.pos)
+            surface_pool.release(scratch)
         
-        surface.blit(self.surface,self.pos)
+        self._dirty = False
+        self._last_rect = rect
+        return rect
         
 
 class UnboundedContainer(Container):
@@ -479,6 +2018,8 @@ class UnboundedContainer(Container):
     It still has a visibility attribute so
     it can be made invisible.
     """
+    __slots__ = ()
+    
     def __init__(self, **kwargs):
         """
         Initialises the UnboundedContainer object.
@@ -486,36 +2027,404 @@ class UnboundedContainer(Container):
           children: The container's children.
           visible: Whether the container is
                    visible or not.
+          index_cell_size: The cell size of the
+                           spatial index.
+          layout: A Layout to position the
+                  children, which mustn't be
+                  reversed. Default None.
+          onchange: Called at the end of a batch,
+                    as for a Container.
         """
         
         self.pos = (0, 0)
         
+        self.onchange = kwargs.get('onchange', lambda x,y: 0)
+        self._batch = None
+        self.layout = kwargs.get('layout')
+        self.fit = None
+        self._layout_from = None
+        self._extent = None
+        self._pending = []
+        self._collected = False
+        self._removed = []
+        self._reported = set()
+        self._index = GridIndex(kwargs.get('index_cell_size', 64))
+        self._moved = set()
+        self._autosizing = []
         self.children = kwargs.get('children',[])
         self.visible = kwargs.get('visible',True)
         
     
-    # Override these to make 'size' do nothing.
-    @property
-    def size(self):
-        return None
-
-    @size.setter
-    def size(self, size):
-        return
-        
+    # Override these to make 'size' do nothing.
+    @property
+    def size(self):
+        return None
+
+    @size.setter
+    def size(self, size):
+        return
+    
+    def get_rect(self):
+        # We cover whatever our children cover.
+        rects = [c.get_rect() for c in self.children if c.visible]
+        if not rects:
+            return pygame.Rect(0, 0, 0, 0)
+        return rects[0].unionall(rects[1:])
+    
+    def _drawn_rects(self):
+        # Our rect isn't kept up to date,
+        # so ask the children instead, and
+        # include any removed since.
+        if self._last_rect is None:
+            return []
+        rects = list(self._removed)
+        for c in self.children:
+            rects.extend(c._drawn_rects())
+        return rects
+    
+    def get_dirty_rects(self):
+        if not self.visible:
+            # We've just been hidden, so
+            # whatever we drew must go.
+            rects, self._removed = self._removed, []
+            if self._last_rect is None:
+                return []
+            return rects + self._drawn_rects()
+        
+        rects = []
+        if self._last_rect is None:
+            # We've just been shown.
+            rects.append(self.get_rect())
+        rects.extend(self._child_dirty_rects())
+        return rects
+            
+    def draw(self, surface):
+        if not self.visible:
+            self._last_rect = None
+            return
+        
+        self._draw_children(surface)
+        
+        # Working out our rect means looking at
+        # every child, so only do it once after
+        # being shown. While we're visible, it's
+        # just a sign that we have been drawn.
+        if self._last_rect is None:
+            self._last_rect = self.get_rect()
+        return self._last_rect
+
+
+class ScrollContainer(Container):
+    """
+    A container which scrolls a column of
+    children through a window its size.
+    Only the children in view are updated,
+    drawn or sent events, so the cost of a
+    frame depends on how many are showing
+    rather than how many there are.
+    
+    Either children are given as usual and
+    stacked top to bottom, in order, or rows
+    are made on demand to show the items of
+    a source sequence, and reused for other
+    items as they scroll out of view.
+    
+    The children's positions are relative to
+    the window, and set by the container:
+    only the x position of a given child is
+    left alone.
+    """
+    __slots__ = ('_scroll', 'scroll_step', 'spacing', 'bar_colour',
+                 '_source', 'row_height', 'make_row', 'bind_row', '_tops',
+                 '_in_view', '_view', '_rows', '_spare')
+    
+    def __init__(self, pos, **kwargs):
+        """
+        Initialises the ScrollContainer object.
+        Allows the keyword arguments of a
+        Container (except layout and fit),
+        and the following:
+          spacing: The gap between children.
+                   Default 0.
+          scroll_step: How far one click of the
+                       mouse wheel scrolls, in
+                       pixels. Default 40.
+          bar_colour: The colour of the scroll bar.
+                      Of format (red, green, blue).
+          source: A sequence of items to show,
+                  one per row, instead of
+                  children.
+          row_height: The height of every row.
+                      Needed with source.
+          make_row: A function which returns a new
+                    row element. Needed with source.
+          bind_row: A function taking a row, an
+                    item and the item's index, which
+                    makes the row show the item.
+                    Needed with source.
+        """
+        self._scroll = 0
+        self.scroll_step = kwargs.get('scroll_step', 40)
+        self.spacing = kwargs.get('spacing', 0)
+        self.bar_colour = kwargs.get('bar_colour', (180,180,180))
+        
+        self._source = kwargs.get('source')
+        self.row_height = kwargs.get('row_height')
+        self.make_row = kwargs.get('make_row')
+        self.bind_row = kwargs.get('bind_row')
+        
+        # The top of each child in the column,
+        # then the bottom of the last, or None
+        # if they need measuring again.
+        self._tops = None
+        # The children in view, in order, and
+        # (scroll, size, rows) they're for.
+        self._in_view = []
+        self._view = None
+        # With a source: index -> row showing
+        # that item, and rows not in use.
+        self._rows = {}
+        self._spare = []
+        
+        kwargs = dict(kwargs, layout=None, fit=None)
+        Container.__init__(self, pos, **kwargs)
+    
+    @property
+    def source(self):
+        return self._source
+    
+    @source.setter
+    def source(self, source):
+        self._source = source
+        self.refresh()
+    
+    def refresh(self):
+        """
+        Show the source's items again, e.g.
+        after they were changed in place.
+        """
+        self._spare.extend(self._rows.values())
+        self._rows = {}
+        self._view = None
+        self.mark_dirty()
+    
+    @property
+    def content_height(self):
+        """
+        The height of everything there
+        is to scroll through.
+        """
+        if self._source is not None:
+            return len(self._source) * self.row_height
+        tops = self._measure()
+        return max(0, tops[-1] - self.spacing) if len(tops) > 1 else 0
+    
+    @property
+    def scroll(self):
+        """
+        How far down the content the top
+        of the window is, in pixels.
+        """
+        return self._scroll
+    
+    @scroll.setter
+    def scroll(self, scroll):
+        scroll = max(0, min(int(scroll),
+                            self.content_height - self.size[1]))
+        if scroll != self._scroll:
+            self._scroll = scroll
+            self._view = None
+            self.mark_dirty()
+    
+    def scroll_to(self, index):
+        """
+        Scroll so that the child (or row) with
+        the given index is in view.
+        """
+        if self._source is not None:
+            top = index * self.row_height
+            bottom = top + self.row_height
+        else:
+            tops = self._measure()
+            top, bottom = tops[index], tops[index] + \
+                self._children[index].size[1]
+        if top < self._scroll:
+            self.scroll = top
+        elif bottom > self._scroll + self.size[1]:
+            self.scroll = bottom - self.size[1]
+    
+    def _measure(self):
+        """
+        Returns the tops of the children,
+        working them out if needed.
+        """
+        if self._tops is None:
+            tops = [0]
+            for c in self._children:
+                tops.append(tops[-1] + c.size[1] + self.spacing)
+            self._tops = tops
+        return self._tops
+    
+    def _children_changed(self, old=()):
+        Container._children_changed(self, old)
+        self._tops = None
+        self._view = None
+    
+    def _children_added(self, start):
+        ref = weakref.ref(self)
+        tops = self._tops
+        for c in self._children[start:]:
+            c._parent = ref
+            if tops is not None:
+                tops.append(tops[-1] + c.size[1] + self.spacing)
+            if hasattr(c, 'autosize'):
+                self._autosizing.append(c)
+        # Only matters if they're in view, and
+        # then they'll be looked at once found.
+        self._view = None
+        self._report_change()
+    
+    def _child_moved(self, child):
+        self._tops = None
+        self._view = None
+        self.mark_dirty()
+    
+    def _live_children(self):
+        if self._view != (self._scroll, self.size,
+                          self._source is not None and len(self._source)):
+            self._find_visible()
+        return self._in_view
+    
+    def _find_visible(self):
+        """
+        Work out which children are in view,
+        and put them in place.
+        """
+        top, height = self._scroll, self.size[1]
+        
+        if self._source is None:
+            tops = self._measure()
+            # The first child whose bottom is below
+            # the top of the window, up to the last
+            # whose top is above its bottom.
+            first = max(0, bisect.bisect_right(tops, top) - 1)
+            last = bisect.bisect_left(tops, top + height, first,
+                                      len(tops) - 1)
+            visible = self._children[first:last]
+            for c, y in zip(visible, tops[first:last]):
+                # (Set directly: this isn't a move
+                # the column needs telling about.)
+                c._pos = [c._pos[0], y - top]
+        else:
+            rh = self.row_height
+            first = top // rh
+            last = min(len(self._source), -(-(top + height) // rh))
+            wanted = range(first, last)
             
-    def draw(self, surface):
+            # Recycle the rows which have
+            # scrolled out of view...
+            for i in [i for i in self._rows if i not in wanted]:
+                self._spare.append(self._rows.pop(i))
+            # ...for the items scrolling in.
+            ref = weakref.ref(self)
+            visible = []
+            for i in wanted:
+                row = self._rows.get(i)
+                if row is None:
+                    row = self._spare.pop() if self._spare else self.make_row()
+                    row._parent = ref
+                    self.bind_row(row, self._source[i], i)
+                    self._rows[i] = row
+                row._pos = [row._pos[0], i * rh - top]
+                visible.append(row)
+            # The rows in use are our children.
+            # (Set directly, since a change of
+            # children would find them again.)
+            self._children = ChildList(self, visible)
+            self._index_stale = True
+        
+        self._in_view = visible
+        self._view = (self._scroll, self.size,
+                      self._source is not None and len(self._source))
+        # Look at what has come into view, in
+        # case it's part way through animating.
+        self._reported.update(visible)
+        self._report_change()
+    
+    def _child_dirty_rects(self):
+        # Only the children in view are looked
+        # at. The rest are looked at again when
+        # they come into view.
+        self._reported.intersection_update(self._live_children())
+        return Container._child_dirty_rects(self)
+    
+    def children_at(self, pos):
+        return [c for c in self._live_children()
+                if c.get_rect().collidepoint(pos)]
+    
+    def _children_in(self, rect):
+        return [c for c in self._live_children()
+                if c.get_rect().colliderect(rect)]
+    
+    def update(self):
+        # Only what's in view updates. (Nothing
+        # else can be seen changing anyway.)
+        for c in self._live_children():
+            if type(c).update is not BaseUIElement.update:
+                c.update()
+        
+        # Children are found without the
+        # spatial index, so it isn't kept.
+        self._moved.clear()
+        self._collected = False
+    
+    def handle_event(self, event, mousepos):
         if not self.visible:
             return
         
-        for c in self.children:
+        if event.type == pygame.MOUSEWHEEL and \
+           self.get_rect().collidepoint(mousepos):
+            self.scroll -= event.y * self.scroll_step
+            return
+        
+        Container.handle_event(self, event, mousepos)
+    
+    def _draw_children(self, surface):
+        clip = surface.get_clip()
+        pending = set(self._pending)
+        self._pending = []
+        for c in self._live_children():
+            # Hidden children still get drawn
+            # so they can forget their old rect.
+            if c.visible and c not in pending and \
+               not clip.colliderect(c.get_rect()):
+                continue
             c.draw(surface)
+        
+        # The scroll bar, if there's
+        # anything to scroll to.
+        content = self.content_height
+        width, height = self.size
+        if content > height:
+            thumb = max(20, height * height // content)
+            y = self._scroll * (height - thumb) // (content - height)
+            pygame.draw.rect(surface, self.bar_colour,
+                             (width - 6, y, 4, thumb), border_radius=2)
 
 
 class Button(BaseUIElement):
     """
     A button.
     """
+    # The button's background and outline,
+    # shared between all buttons which
+    # look the same.
+    frame_cache = SurfaceCache(8 * 1024 * 1024)
+    
+    __slots__ = ('_size', '_radius', '_font', '_colour', '_bg_colour',
+                 '_outline_colour', '_outline_width', 'onclick', 'ink',
+                 'ink_colour', 'ink_duration', '_inks', '_text',
+                 '_text_image')
 
     def __init__(self, pos, **kwargs):
         """
@@ -553,7 +2462,9 @@ class Button(BaseUIElement):
         """
         self.pos = list(pos)
         
-        self._font = kwargs.get('font', pygame.font.Font(None, 36))
+        # Fonts are shared, rather than
+        # loaded again for every button.
+        self._font = kwargs.get('font', None) or get_font(None, 36)
         
         self._colour = list(kwargs.get('colour',(0,0,0)))
         self._bg_colour = list(kwargs.get('bg_colour',(255,255,255)))
@@ -575,35 +2486,45 @@ class Button(BaseUIElement):
 
     @property
     def size(self):
-        return self._tmp.get_size()
+        return self._size
 
     @size.setter
     def size(self, size):
-        self._tmp = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._tmp = self._tmp.convert_alpha()
-        
-        self._innertmp = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._innertmp = self._innertmp.convert_alpha()
-        
-        self._tmp.fill(self.outline_colour)
-        self._innertmp.fill(self.bg_colour)
+        self._size = tuple(size)
         
         self._radius = max(size) * 0.25
         
-        self._inktmp = pygame.Surface([int(self._radius*2)]*2, pygame.SRCALPHA, 32)
-        self._inktmp = self._inktmp.convert_alpha()
-        
-        self._inksurf = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._inksurf = self._inksurf.convert_alpha()
-        
-        self._textsurf = pygame.Surface(size, pygame.SRCALPHA, 32)
-        self._textsurf = self._textsurf.convert_alpha()
+        self.mark_dirty()
+        self.invalidate_layout()
+    
+    def _get_frame(self):
+        """
+        Returns the button's background
+        and outline, from the shared cache
+        if possible.
+        """
+        key = (self.size, tuple(self.outline_colour), tuple(self.bg_colour),
+               self.outline_width)
         
-        self._tmp.blit(self._innertmp,
+        frame = Button.frame_cache.get(key)
+        if frame is None:
+            size = self.size
+            
+            frame = pygame.Surface(size, pygame.SRCALPHA, 32)
+            frame = frame.convert_alpha()
+            frame.fill(self.outline_colour)
+            
+            innertmp = surface_pool.acquire(size)
+            innertmp.fill(self.bg_colour)
+            frame.blit(innertmp,
                        (self.outline_width,) * 2,
                        (self.outline_width,) * 2 +
                        (size[0] - 2*self.outline_width,
                         size[1] - 2*self.outline_width))
+            surface_pool.release(innertmp)
+            
+            Button.frame_cache.put(key, frame)
+        return frame
 
     @property
     def text(self):
@@ -633,12 +2554,11 @@ class Button(BaseUIElement):
     def text(self, text):
         self._text = text
         
-        # render text
-        text = self.font.render(self.text, True, self.colour)
-        self._textsurf.fill(0)
-        self._textsurf.blit(text,
-                           ((self.size[0] - text.get_width()) // 2,
-                            (self.size[1] - text.get_height()) // 2))
+        # render text, or reuse it if the same
+        # text has been rendered before
+        self._text_image = render_text(self.font, self.text, self.colour)
+        
+        self.mark_dirty()
 
     @font.setter
     def font(self, font):
@@ -681,6 +2601,30 @@ class Button(BaseUIElement):
             
         return 0 <= pos[0]-(self.pos[0]) < self.size[0] and \
                0 <= pos[1]-(self.pos[1]) < self.size[1]
+    
+    def is_dirty(self):
+        return self._dirty or bool(self._inks)
+    
+    def _expire_inks(self):
+        """
+        Forget the ink ripples which have
+        finished, as drawing does, in case
+        the button isn't being drawn (e.g.
+        it is hidden). Returns whether any
+        were forgotten.
+        """
+        end = get_time() - self.ink_duration*1000
+        inks = [(p, t) for p, t in self._inks if t >= end]
+        if len(inks) == len(self._inks):
+            return False
+        self._inks = inks
+        # One more frame, to wipe them
+        # off if they were drawn.
+        self.mark_dirty()
+        return True
+    
+    def is_animating(self):
+        return self._expire_inks() or bool(self._inks)
                
     def create_ink(self, pos = None):
         """
@@ -697,6 +2641,7 @@ class Button(BaseUIElement):
             pos = (self.size[0] // 2, self.size[1] // 2)
         
         self._inks.append((pos, get_time()))
+        self._report_change()
                
     def click(self, ink = True):
         """
@@ -736,12 +2681,19 @@ class Button(BaseUIElement):
 
     def draw(self, surface):
         if not self.visible:
+            self._last_rect = None
             return
         
+        # Draw to screen
+        surface.blit(self._get_frame(), self.pos)
+        
         # Draw ink ripples
-        if self.ink:
-            # clear temporary ink surface
-            self._inksurf.fill(0)
+        if self.ink and self._inks:
+            # The ink is drawn onto a scratch
+            # surface first, to cut it off at
+            # the edges of the button.
+            inksurf = surface_pool.acquire(self.size)
+            inksurf.fill(0)
             
             curr_time = get_time()
             newinks = []
@@ -754,27 +2706,892 @@ class Button(BaseUIElement):
                     # in time calculations.
                     # just pretend nothing happened...
                     continue
-                self._inktmp.fill((255,255,255,0))
-                pygame.draw.circle(self._inktmp, self.ink_colour[:3]+
-                                   [255 - int(255 * 
-                                              (curr_time-t) / 
-                                              (self.ink_duration*1000)
-                                              )],
-                                   [int(self._radius)]*2,
-                                   int(self._radius/2+
-                                       (self._radius/2)*
-                                       # Deceleration curve
-                                       math.sqrt(
-                                            (curr_time-t)/
-                                            (self.ink_duration*1000)
-                                            )
-                                       )
-                                   )
-                self._inksurf.blit(self._inktmp,
-                                   [p[0]-self._radius,p[1]-self._radius])
+                inksurf.blit(ink_sprite(self._radius,
+                                        (curr_time-t) /
+                                        (self.ink_duration*1000)),
+                             [p[0]-self._radius,p[1]-self._radius])
             self._inks = newinks
             
-        # Draw to screen
-        surface.blit(self._tmp, self.pos)
-        surface.blit(self._inksurf, self.pos)
-        surface.blit(self._textsurf, self.pos)
+            # The sprites are white: colour
+            # them all at once.
+            inksurf.fill(self.ink_colour[:3],
+                         special_flags=pygame.BLEND_RGBA_MULT)
+            surface.blit(inksurf, self.pos)
+            surface_pool.release(inksurf)
+        
+        # Center the text, cutting off
+        # anything outside the button.
+        width, height = self.size
+        text_width, text_height = self._text_image.get_size()
+        x = (width - text_width) // 2
+        y = (height - text_height) // 2
+        surface.blit(self._text_image,
+                     (self.pos[0] + max(x, 0), self.pos[1] + max(y, 0)),
+                     (max(-x, 0), max(-y, 0),
+                      min(text_width, width), min(text_height, height)))
+        
+        self._dirty = False
+        self._last_rect = self.get_rect()
+        return self._last_rect
+
+
+
+class GridView(BaseUIElement):
+    """
+    Shows a 2D NumPy array of cell states,
+    indexed [y, x], with one colour per state.
+    Changes to the array are reported with
+    mark_cells, and only the tiles containing
+    those cells are uploaded and redrawn, so
+    the cost follows how much of the grid
+    changes, not how big it is.
+    """
+    # Used for states without a palette entry.
+    default_palette = ((255,255,255), (0,0,0), (220,50,47),
+                       (38,139,210), (133,153,0), (211,54,130),
+                       (181,137,0), (42,161,152))
+    
+    __slots__ = ('_cell_size', 'tile_size', 'track_changes', '_grid',
+                 '_palette', '_image', '_shown', '_marked', '_tiles',
+                 '_reupload')
+    
+    def __init__(self, pos, grid, **kwargs):
+        """
+        Initialises the grid view.
+        Allows the following keyword arguments:
+          palette: A list of colours, one per
+                   cell state. Of format
+                   (red, green, blue).
+          cell_size: The size of a cell
+                     in pixels. Default 4.
+          tile_size: The size of the tiles the
+                     grid is uploaded in, in cells.
+                     Default 32.
+          track_changes: Whether to also find the
+                         changed cells by comparing
+                         the whole grid with what was
+                         last drawn, every frame,
+                         for when they can't be
+                         reported with mark_cells.
+                         Default False.
+          visible: Whether the grid is visible.
+        """
+        self.pos = list(pos)
+        
+        self._cell_size = kwargs.get('cell_size', 4)
+        self.tile_size = kwargs.get('tile_size', 32)
+        self.track_changes = kwargs.get('track_changes', False)
+        self.visible = kwargs.get('visible', True)
+        
+        self._grid = None
+        self.palette = kwargs.get('palette', self.default_palette)
+        self.grid = grid
+    
+    @property
+    def grid(self):
+        return self._grid
+    
+    @grid.setter
+    def grid(self, grid):
+        if self._grid is None or grid.shape != self._grid.shape:
+            # Start again from scratch.
+            self._grid = grid
+            self._reset()
+        elif grid is not self._grid:
+            # A different array, so nothing
+            # shown can be assumed to match.
+            self._grid = grid
+            self._reupload = True
+    
+    @property
+    def palette(self):
+        return self._palette
+    
+    @palette.setter
+    def palette(self, palette):
+        self._palette = np.array(palette, dtype=np.uint8).reshape(-1, 3)
+        self._reupload = True
+    
+    @property
+    def cell_size(self):
+        return self._cell_size
+    
+    @cell_size.setter
+    def cell_size(self, cell_size):
+        self._cell_size = cell_size
+        self._reset()
+    
+    @property
+    def size(self):
+        height, width = self._grid.shape
+        return (width * self._cell_size, height * self._cell_size)
+    
+    def _reset(self):
+        # Everything will be uploaded
+        # on the next update.
+        self._image = pygame.Surface(self.size).convert()
+        self._shown = None
+        self._marked = []
+        self._tiles = []
+        self._reupload = True
+    
+    def mark_dirty(self):
+        self._reupload = True
+    
+    def mark_cells(self, left, top, right, bottom):
+        """
+        Report that the cells in the given
+        rect (right and bottom exclusive)
+        may have changed. Changes made to the
+        grid in place aren't shown until
+        they're reported (unless
+        track_changes is on).
+        """
+        self._marked.append((left, top, right, bottom))
+    
+    def cell_at(self, pos):
+        """
+        The (x, y) index of the cell at a
+        position relative to the parent,
+        or None if it's outside the grid.
+        """
+        x = (pos[0] - self.pos[0]) // self._cell_size
+        y = (pos[1] - self.pos[1]) // self._cell_size
+        height, width = self._grid.shape
+        if 0 <= x < width and 0 <= y < height:
+            return (int(x), int(y))
+        return None
+    
+    def collide(self, pos):
+        return self.get_rect().collidepoint(pos)
+    
+    def _changed_tiles(self):
+        """
+        Returns the (tx, ty) indices of
+        the tiles that need uploading.
+        """
+        t = self.tile_size
+        height, width = self._grid.shape
+        tiles_x = -(-width // t)
+        
+        ids = []
+        if self.track_changes and self._shown is not None:
+            ys, xs = np.nonzero(self._grid != self._shown)
+            ids.append((ys // t) * tiles_x + xs // t)
+        for left, top, right, bottom in self._marked:
+            left, top = max(left, 0), max(top, 0)
+            right, bottom = min(right, width), min(bottom, height)
+            if left >= right or top >= bottom:
+                continue
+            tx = np.arange(left // t, (right - 1) // t + 1)
+            ty = np.arange(top // t, (bottom - 1) // t + 1)
+            ids.append((ty[:, None] * tiles_x + tx).ravel())
+        self._marked = []
+        
+        if not ids:
+            return []
+        ids = np.unique(np.concatenate(ids))
+        return list(zip((ids % tiles_x).tolist(), (ids // tiles_x).tolist()))
+    
+    def _upload(self, left, top, right, bottom):
+        """
+        Draw a block of cells onto the image.
+        """
+        cells = self._grid[top:bottom, left:right]
+        # Wrap states without a colour of their
+        # own around to the start of the palette.
+        rgb = self._palette.take(cells, axis=0, mode='wrap')
+        s = self._cell_size
+        if s > 1:
+            rgb = rgb.repeat(s, axis=0).repeat(s, axis=1)
+        target = self._image.subsurface(
+            (left * s, top * s, (right - left) * s, (bottom - top) * s))
+        # surfarray is indexed [x, y]
+        pygame.surfarray.blit_array(target, rgb.transpose(1, 0, 2))
+    
+    def update(self):
+        if not self.visible:
+            return
+        
+        height, width = self._grid.shape
+        s = self._cell_size
+        if self._reupload:
+            self._upload(0, 0, width, height)
+            self._tiles = [pygame.Rect(self.pos, self.size)]
+            self._marked = []
+            self._reupload = False
+        else:
+            t = self.tile_size
+            for tx, ty in self._changed_tiles():
+                left, top = tx * t, ty * t
+                right, bottom = min(left + t, width), min(top + t, height)
+                self._upload(left, top, right, bottom)
+                self._tiles.append(pygame.Rect(
+                    self.pos[0] + left * s, self.pos[1] + top * s,
+                    (right - left) * s, (bottom - top) * s))
+        
+        if self.track_changes:
+            if self._shown is None:
+                self._shown = self._grid.copy()
+            else:
+                self._shown[...] = self._grid
+        
+        if self._tiles:
+            self._report_change()
+    
+    def is_dirty(self):
+        return bool(self._tiles)
+    
+    def get_dirty_rects(self):
+        rect = self.get_rect() if self.visible else None
+        if rect != self._last_rect:
+            # Moved, resized, shown or hidden
+            return [r for r in (self._last_rect, rect) if r]
+        return list(self._tiles) if rect else []
+    
+    def draw(self, surface):
+        if not self.visible:
+            self._last_rect = None
+            return
+        
+        surface.blit(self._image, self.pos)
+        self._tiles = []
+        
+        self._last_rect = self.get_rect()
+        return self._last_rect
+
+
+class GridViewport(BaseUIElement):
+    """
+    A zoomable, pannable view of a 2D NumPy
+    array of cell states, indexed [y, x], for
+    grids far too big to draw in full.
+    Drag to pan and use the mouse wheel to zoom.
+    
+    The grid is kept as a pyramid of levels,
+    each half the size of the one below, where
+    a cell holds the highest state of the four
+    cells beneath it (so that nothing vanishes
+    when zoomed out). The view is drawn from
+    tiles of whichever level has about one cell
+    per pixel, so drawing the whole world costs
+    the same as drawing a small part of it.
+    """
+    __slots__ = ('size', 'tile_size', 'min_zoom', 'max_zoom', 'bg_colour',
+                 'view', 'zoom', 'origin', '_tiles', '_palette', '_levels',
+                 '_drag')
+    
+    def __init__(self, pos, size, grid, **kwargs):
+        """
+        Initialises the viewport.
+        Allows the following keyword arguments:
+          origin: The world coordinates of
+                  grid[0, 0]. Default (0, 0).
+          palette: A list of colours, one per
+                   cell state. Of format
+                   (red, green, blue).
+          tile_size: The width and height of each
+                     tile, in cells. Default 64.
+          zoom: The size of a cell in pixels.
+                Default 1.
+          min_zoom: The smallest zoom allowed.
+                    Default: enough to show
+                    the whole grid.
+          max_zoom: The largest zoom allowed.
+                    Default 32.
+          bg_colour: The colour outside the grid.
+                     Of format (red, green, blue).
+                     Default is grey.
+          cache_bytes: The memory cap on cached
+                       tile surfaces, in bytes.
+                       Default 16MB.
+          visible: Whether the viewport is visible.
+        """
+        self.pos = list(pos)
+        self.size = list(size)
+        
+        self.tile_size = kwargs.get('tile_size', 64)
+        self.min_zoom = kwargs.get('min_zoom', None)
+        self.max_zoom = kwargs.get('max_zoom', 32)
+        self.bg_colour = list(kwargs.get('bg_colour', (128,128,128)))
+        self.visible = kwargs.get('visible', True)
+        
+        self._tiles = SurfaceCache(kwargs.get('cache_bytes', 16*1024*1024))
+        self._palette = np.array(kwargs.get('palette',
+                                            GridView.default_palette),
+                                 dtype=np.uint8).reshape(-1, 3)
+        
+        # The world coordinates of the
+        # top left corner of the view.
+        self.view = [0.0, 0.0]
+        self.zoom = kwargs.get('zoom', 1)
+        
+        # The position the drag started
+        # from, or None if not dragging.
+        self._drag = None
+        
+        self.set_grid(grid, kwargs.get('origin', (0, 0)))
+    
+    @property
+    def grid(self):
+        return self._levels[0]
+    
+    @grid.setter
+    def grid(self, grid):
+        self.set_grid(grid, self.origin)
+    
+    @property
+    def palette(self):
+        return self._palette
+    
+    @palette.setter
+    def palette(self, palette):
+        self._palette = np.array(palette, dtype=np.uint8).reshape(-1, 3)
+        self._tiles.clear()
+        self.mark_dirty()
+    
+    def set_grid(self, grid, origin=(0, 0)):
+        """
+        Show a new grid, whose top left cell
+        is at origin in world coordinates.
+        The view stays where it is in the
+        world, so a grid which has grown
+        doesn't appear to move.
+        This rebuilds the whole pyramid; if
+        only some cells changed, use
+        mark_cells instead.
+        """
+        self.origin = tuple(origin)
+        self._levels = [grid]
+        while max(self._levels[-1].shape) > self.tile_size:
+            self._levels.append(self._downsample(self._levels[-1]))
+        
+        self._tiles.clear()
+        self.mark_dirty()
+    
+    @staticmethod
+    def _downsample(cells):
+        """
+        Halve an array, keeping the
+        highest state of each 2x2 block.
+        """
+        height, width = cells.shape
+        if height % 2 or width % 2:
+            # Pad with empty cells
+            padded = np.zeros((height + height % 2, width + width % 2),
+                              dtype=cells.dtype)
+            padded[:height, :width] = cells
+            cells = padded
+        height, width = cells.shape
+        return cells.reshape(height // 2, 2, width // 2, 2).max(axis=(1, 3))
+    
+    def mark_cells(self, left, top, right, bottom):
+        """
+        Report that the cells in the given rect
+        of grid indices (right and bottom
+        exclusive) may have changed.
+        For an ant which was at (x, y) before
+        taking n steps, the rect
+        (x-n, y-n, x+n+1, y+n+1)
+        always covers what changed.
+        """
+        visible = self._visible_tiles()
+        for level in range(len(self._levels)):
+            cells = self._levels[level]
+            height, width = cells.shape
+            left, top = max(left, 0), max(top, 0)
+            right, bottom = min(right, width), min(bottom, height)
+            if left >= right or top >= bottom:
+                return
+            
+            if level:
+                # Rebuild this part of the level
+                # from the one below it.
+                below = self._levels[level - 1]
+                block = below[top*2:bottom*2, left*2:right*2]
+                cells[top:bottom, left:right] = self._downsample(block)
+            
+            # Throw away the tiles which
+            # showed the old cells.
+            t = self.tile_size
+            for tx in range(left // t, (right - 1) // t + 1):
+                for ty in range(top // t, (bottom - 1) // t + 1):
+                    self._tiles.discard((level, tx, ty))
+                    if (level, tx, ty) in visible:
+                        self.mark_dirty()
+            
+            # The same cells in the next level up
+            left, top = left // 2, top // 2
+            right, bottom = (right + 1) // 2, (bottom + 1) // 2
+    
+    def _level(self):
+        """
+        The pyramid level to draw from at the
+        current zoom: the most detailed one
+        with at most one cell per pixel,
+        or level 0 when zoomed in.
+        """
+        if self.zoom >= 1:
+            return 0
+        level = int(math.floor(math.log2(1 / self.zoom)))
+        return min(level, len(self._levels) - 1)
+    
+    def _visible_tiles(self):
+        """
+        Returns a dict of (level, tx, ty) for each
+        tile in view, to the range of screen
+        pixels it covers, relative to the viewport.
+        """
+        level = self._level()
+        cells = self._levels[level]
+        height, width = cells.shape
+        scale = 1 << level
+        t = self.tile_size
+        
+        # The visible range of cells at this level
+        left = (self.view[0] - self.origin[0]) / scale
+        top = (self.view[1] - self.origin[1]) / scale
+        right = left + self.size[0] / (self.zoom * scale)
+        bottom = top + self.size[1] / (self.zoom * scale)
+        
+        tiles = {}
+        for tx in range(max(int(left) // t, 0),
+                        min(int(math.ceil(right)), width - 1) // t + 1):
+            for ty in range(max(int(top) // t, 0),
+                            min(int(math.ceil(bottom)), height - 1) // t + 1):
+                tiles[(level, tx, ty)] = None
+        return tiles
+    
+    def _screen(self, x, y, level):
+        """
+        Converts a cell corner at the given
+        level to a pixel position, relative
+        to the viewport.
+        """
+        scale = (1 << level)
+        return (int(round((x * scale + self.origin[0] - self.view[0])
+                          * self.zoom)),
+                int(round((y * scale + self.origin[1] - self.view[1])
+                          * self.zoom)))
+    
+    def _get_tile(self, key):
+        """
+        Returns the surface of a tile,
+        at one pixel per cell.
+        """
+        tile = self._tiles.get(key)
+        if tile is None:
+            level, tx, ty = key
+            t = self.tile_size
+            cells = self._levels[level][ty*t:(ty+1)*t, tx*t:(tx+1)*t]
+            rgb = self._palette.take(cells, axis=0, mode='wrap')
+            # surfarray is indexed [x, y]
+            tile = pygame.surfarray.make_surface(rgb.transpose(1, 0, 2))
+            tile = tile.convert()
+            self._tiles.put(key, tile)
+        return tile
+    
+    def zoom_at(self, factor, pos):
+        """
+        Zoom by factor, keeping the world point
+        under pos (relative to the viewport)
+        in the same place.
+        """
+        zoom = self.zoom * factor
+        min_zoom = self.min_zoom
+        if min_zoom is None:
+            height, width = self.grid.shape
+            min_zoom = min(self.size[0] / width, self.size[1] / height, 1)
+        zoom = max(min_zoom, min(zoom, self.max_zoom))
+        
+        # The world point under the cursor
+        wx = self.view[0] + pos[0] / self.zoom
+        wy = self.view[1] + pos[1] / self.zoom
+        self.zoom = zoom
+        self.view = [wx - pos[0] / zoom, wy - pos[1] / zoom]
+        self.mark_dirty()
+    
+    def pan(self, dx, dy):
+        """
+        Move the view by (dx, dy) pixels.
+        """
+        self.view[0] -= dx / self.zoom
+        self.view[1] -= dy / self.zoom
+        self.mark_dirty()
+    
+    def fit(self):
+        """
+        Zoom and pan to show the whole grid.
+        """
+        height, width = self.grid.shape
+        self.zoom = min(self.size[0] / width, self.size[1] / height)
+        self.view = [self.origin[0] + (width - self.size[0]/self.zoom) / 2,
+                     self.origin[1] + (height - self.size[1]/self.zoom) / 2]
+        self.mark_dirty()
+    
+    def world_at(self, pos):
+        """
+        The world coordinates of the cell at
+        a position relative to the parent.
+        """
+        return (int(math.floor(self.view[0] +
+                               (pos[0] - self.pos[0]) / self.zoom)),
+                int(math.floor(self.view[1] +
+                               (pos[1] - self.pos[1]) / self.zoom)))
+    
+    def collide(self, pos):
+        return self.get_rect().collidepoint(pos)
+    
+    def handle_event(self, event, mousepos):
+        if not self.visible:
+            return
+        
+        relpos = (mousepos[0] - self.pos[0], mousepos[1] - self.pos[1])
+        
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if self.collide(mousepos):
+                self._drag = relpos
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+            self._drag = None
+        elif event.type == pygame.MOUSEMOTION and self._drag is not None:
+            if not event.buttons[0]:
+                # The button was released
+                # somewhere we didn't see.
+                self._drag = None
+                return
+            self.pan(relpos[0] - self._drag[0], relpos[1] - self._drag[1])
+            self._drag = relpos
+        elif event.type == pygame.MOUSEWHEEL:
+            if self.collide(mousepos):
+                self.zoom_at(1.25 ** event.y, relpos)
+    
+    def draw(self, surface):
+        if not self.visible:
+            self._last_rect = None
+            return
+        
+        rect = self.get_rect()
+        
+        old_clip = surface.get_clip()
+        surface.set_clip(rect.clip(old_clip))
+        surface.fill(self.bg_colour, rect)
+        
+        t = self.tile_size
+        for key in self._visible_tiles():
+            level, tx, ty = key
+            tile = self._get_tile(key)
+            
+            # Where the tile's corners land, so that
+            # neighbouring tiles meet exactly.
+            x0, y0 = self._screen(tx * t, ty * t, level)
+            x1, y1 = self._screen(tx * t + tile.get_width(),
+                                  ty * t + tile.get_height(), level)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            
+            # Only scale the part of the tile in view, so
+            # the cost follows the size of the viewport.
+            visible = pygame.Rect(x0, y0, x1 - x0, y1 - y0).clip(
+                (0, 0) + tuple(self.size))
+            if not visible.w or not visible.h:
+                continue
+            sx = tile.get_width() / (x1 - x0)
+            sy = tile.get_height() / (y1 - y0)
+            left = int((visible.left - x0) * sx)
+            top = int((visible.top - y0) * sy)
+            right = min(int(math.ceil((visible.right - x0) * sx)),
+                        tile.get_width())
+            bottom = min(int(math.ceil((visible.bottom - y0) * sy)),
+                         tile.get_height())
+            part = tile.subsurface((left, top, right - left, bottom - top))
+            
+            # The pixel rect of the cells in part
+            px0, py0 = self._screen(tx * t + left, ty * t + top, level)
+            px1, py1 = self._screen(tx * t + right, ty * t + bottom, level)
+            if part.get_size() != (px1 - px0, py1 - py0):
+                part = pygame.transform.scale(part, (px1 - px0, py1 - py0))
+            surface.blit(part, (rect.x + px0, rect.y + py0))
+        
+        surface.set_clip(old_clip)
+        
+        self._dirty = False
+        self._last_rect = rect
+        return rect
+
+
+class Profiler:
+    """
+    Records the time spent in each element's
+    update, draw and handle_event methods,
+    over a rolling window of frames.
+    
+    While disabled, the profiler isn't hooked
+    into anything, so it costs nothing.
+    Enabling it wraps those methods on every
+    subclass of BaseUIElement.
+    Times are 'self' times: time spent inside
+    a child's method is attributed to the
+    child, not to its container.
+    """
+    METHODS = ('update', 'draw', 'handle_event')
+    
+    def __init__(self, window=120):
+        """
+        Initialises the profiler.
+        window is the number of frames
+        to aggregate statistics over.
+        """
+        # (frame time, {element id: [update, draw, handle_event]})
+        self.frames = deque(maxlen=window)
+        # element id -> description
+        self.labels = {}
+        
+        self.enabled = False
+        
+        self._current = {}
+        self._stack = []
+        self._originals = []
+        self._frame_start = time.perf_counter()
+    
+    @staticmethod
+    def _subclasses(cls):
+        yield cls
+        for sub in cls.__subclasses__():
+            for c in Profiler._subclasses(sub):
+                yield c
+    
+    @staticmethod
+    def _describe(element):
+        pos = getattr(element, 'pos', None)
+        if pos is None:
+            return type(element).__name__
+        return '%s@(%d, %d)' % (type(element).__name__, pos[0], pos[1])
+    
+    def _wrap(self, method, index):
+        stack = self._stack
+        perf_counter = time.perf_counter
+        
+        @functools.wraps(method)
+        def wrapper(element, *args, **kwargs):
+            stack.append(0.0)
+            start = perf_counter()
+            try:
+                return method(element, *args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    # Don't count this against our caller.
+                    stack[-1] += elapsed
+                
+                key = id(element)
+                times = self._current.get(key)
+                if times is None:
+                    times = self._current[key] = [0.0, 0.0, 0.0]
+                    if key not in self.labels:
+                        self.labels[key] = self._describe(element)
+                times[index] += elapsed - children
+        return wrapper
+    
+    def enable(self):
+        """
+        Start recording.
+        Only classes which exist at this
+        point are instrumented. Classes with
+        a false _profile attribute are skipped.
+        """
+        if self.enabled:
+            return
+        
+        for cls in set(self._subclasses(BaseUIElement)):
+            if not getattr(cls, '_profile', True):
+                continue
+            for index, name in enumerate(Profiler.METHODS):
+                # Only wrap methods the class defines
+                # itself; inherited ones are wrapped
+                # where they are defined.
+                if name in cls.__dict__:
+                    method = cls.__dict__[name]
+                    self._originals.append((cls, name, method))
+                    setattr(cls, name, self._wrap(method, index))
+        
+        self.enabled = True
+        self.start_frame()
+    
+    def disable(self):
+        """
+        Stop recording, and remove
+        every hook.
+        """
+        for cls, name, method in reversed(self._originals):
+            setattr(cls, name, method)
+        self._originals = []
+        self._stack[:] = []
+        self.enabled = False
+    
+    def start_frame(self):
+        """
+        Mark the start of a frame.
+        """
+        self._current = {}
+        self._frame_start = time.perf_counter()
+    
+    def end_frame(self):
+        """
+        Mark the end of a frame.
+        Time between end_frame and the
+        next start_frame (e.g. waiting for
+        the clock) isn't counted.
+        """
+        if self.enabled:
+            self.frames.append((time.perf_counter() - self._frame_start,
+                                self._current))
+        self._current = {}
+    
+    def frame_time(self):
+        """
+        The mean frame time over the
+        window, in seconds.
+        """
+        if not self.frames:
+            return 0.0
+        return sum(f[0] for f in self.frames) / len(self.frames)
+    
+    def totals(self):
+        """
+        Returns a dict mapping element ids to
+        lists of the mean time per frame spent
+        in [update, draw, handle_event], in
+        seconds, over the window.
+        """
+        totals = {}
+        for _, times in self.frames:
+            for key, t in times.items():
+                total = totals.setdefault(key, [0.0, 0.0, 0.0])
+                for i in range(3):
+                    total[i] += t[i]
+        
+        n = max(1, len(self.frames))
+        for total in totals.values():
+            for i in range(3):
+                total[i] /= n
+        return totals
+    
+    def top(self, n=10):
+        """
+        Returns the n most expensive elements
+        over the window, as a list of
+        (label, [update, draw, handle_event])
+        tuples sorted by total time.
+        """
+        totals = sorted(self.totals().items(),
+                        key=lambda item: sum(item[1]), reverse=True)
+        return [(self.labels.get(key, '?'), times)
+                for key, times in totals[:n]]
+    
+    def dump(self, path):
+        """
+        Write the data for every frame in
+        the window to a JSON file, for
+        offline analysis.
+        Times are in seconds.
+        """
+        data = {
+            'methods': list(Profiler.METHODS),
+            'labels': {str(k): v for k, v in self.labels.items()},
+            'frames': [{'frame_time': frame_time,
+                        'elements': {str(k): v for k, v in times.items()}}
+                       for frame_time, times in self.frames],
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+
+class ProfilerOverlay(BaseUIElement):
+    """
+    Shows the frame time, FPS and the
+    most expensive elements recorded
+    by a Profiler.
+    """
+    # Don't profile ourselves.
+    _profile = False
+    
+    __slots__ = ('profiler', 'top_n', 'font', 'colour', 'bg_colour',
+                 'toggle_key', '_surface')
+    
+    def __init__(self, pos, profiler, **kwargs):
+        """
+        Initialises the overlay.
+        Allows the following keyword arguments:
+          top_n: How many elements to list.
+                 Default 5.
+          font: A pygame Font object for the text.
+          colour: The text colour.
+                  Of format (red, green, blue).
+                  Default is white.
+          bg_colour: The background colour.
+                     Of format (red, green, blue, alpha).
+                     Default is translucent black.
+          toggle_key: The key which shows and hides
+                      the overlay. Default F3.
+          visible: Whether the overlay is shown.
+                   Default False.
+        """
+        self.pos = list(pos)
+        self.profiler = profiler
+        
+        self.top_n = kwargs.get('top_n', 5)
+        self.font = kwargs.get('font', None) or get_font(None, 20)
+        self.colour = list(kwargs.get('colour', (255,255,255)))
+        self.bg_colour = list(kwargs.get('bg_colour', (0,0,0,192)))
+        self.toggle_key = kwargs.get('toggle_key', pygame.K_F3)
+        self.visible = kwargs.get('visible', False)
+        
+        self._surface = None
+    
+    def get_rect(self):
+        if self._surface is None:
+            return pygame.Rect(self.pos, (0, 0))
+        return pygame.Rect(self.pos, self._surface.get_size())
+    
+    def is_dirty(self):
+        # The numbers change every frame.
+        return self.visible
+    
+    def handle_event(self, event, mousepos):
+        if event.type == pygame.KEYDOWN and event.key == self.toggle_key:
+            self.visible = not self.visible
+    
+    def update(self):
+        if not self.visible:
+            return
+        
+        frame_time = self.profiler.frame_time()
+        lines = ['frame %.2fms  fps %.1f' % (1000*frame_time, get_fps())]
+        for label, (u, d, e) in self.profiler.top(self.top_n):
+            lines.append('%.3fms %s (u %.3f d %.3f e %.3f)' %
+                         (1000*(u+d+e), label, 1000*u, 1000*d, 1000*e))
+        
+        rendered = [self.font.render(line, True, self.colour)
+                    for line in lines]
+        
+        width = max(r.get_width() for r in rendered) + 8
+        height = sum(r.get_height() for r in rendered) + 8
+        
+        self._surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        self._surface.fill(self.bg_colour)
+        y = 4
+        for r in rendered:
+            self._surface.blit(r, (4, y))
+            y += r.get_height()
+        self._report_change()
+    
+    def draw(self, surface):
+        if not self.visible or self._surface is None:
+            self._last_rect = None
+            return
+        
+        surface.blit(self._surface, self.pos)
+        
+        self._last_rect = self.get_rect()
+        return self._last_rect